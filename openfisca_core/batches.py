@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Coalesce the simulations of unrelated requests into a single simulation."""
+
+
+import collections
+import sys
+import threading
+
+import numpy as np
+
+
+class Batch(object):
+    column_names = None
+    error = None  # Exception info, when calculation failed
+    event = None
+    requests = None
+    results = None
+    started = False
+
+    def __init__(self):
+        self.column_names = set()
+        self.event = threading.Event()
+        self.requests = []
+
+
+class Batcher(object):
+    """Gather the simulations given within a time window and calculate them as a single simulation.
+
+    Only simulations sharing the same tax-benefit system, date, compact legislation (ie the same reform) and random seed
+    are merged.
+    Method calculate is meant to be called concurrently, by the threads of a web server for example.
+    """
+    batch_by_key = None
+    lock = None
+    max_batch_size = None
+    window = 0.01  # Delay (in seconds) during which simulations are gathered
+
+    def __init__(self, max_batch_size = None, window = None):
+        self.batch_by_key = {}
+        self.lock = threading.Lock()
+        if max_batch_size is not None:
+            self.max_batch_size = max_batch_size
+        if window is not None:
+            self.window = window
+
+    def calculate(self, simulation, column_names):
+        """Calculate the given columns of a simulation, together with the other simulations of the same batch."""
+        key = (simulation.tax_benefit_system, simulation.date, simulation.compact_legislation, simulation.random_seed)
+        with self.lock:
+            batch = self.batch_by_key.get(key)
+            if batch is None:
+                self.batch_by_key[key] = batch = Batch()
+                threading.Timer(self.window, self.run_batch, args = (key, batch)).start()
+            request_index = len(batch.requests)
+            batch.requests.append(simulation)
+            batch.column_names.update(column_names)
+            is_full = self.max_batch_size is not None and len(batch.requests) >= self.max_batch_size
+        if is_full:
+            # Don't wait for the end of the time window.
+            self.run_batch(key, batch)
+        batch.event.wait()
+        if batch.error is not None:
+            raise batch.error[0], batch.error[1], batch.error[2]
+        return dict(
+            (column_name, batch.results[request_index][column_name])
+            for column_name in column_names
+            )
+
+    def run_batch(self, key, batch):
+        with self.lock:
+            if batch.started:
+                return
+            batch.started = True
+            # Next simulations go to a new batch.
+            if self.batch_by_key.get(key) is batch:
+                del self.batch_by_key[key]
+        try:
+            simulation, slices_by_key_plural = concatenate(batch.requests)
+            batch.results = results = [{} for request in batch.requests]
+            for column_name in batch.column_names:
+                holder = simulation.compute(column_name)
+                key_plural = holder.entity.key_plural
+                for result, slice_by_key_plural in zip(results, slices_by_key_plural):
+                    result[column_name] = holder.array[slice_by_key_plural[key_plural]]
+        except:
+            batch.error = sys.exc_info()
+        batch.event.set()
+
+
+def concatenate(simulations):
+    """Merge the input arrays of several simulations into a single simulation.
+
+    Simulations must share the same tax-benefit system, date, compact legislation and random seed. The "id*" columns of
+    persons are re-based, while original positions are kept, so that each simulation keeps its random streams.
+    Returns the new simulation and, for each given simulation, the slice of its members by entity.
+    """
+    first_simulation = simulations[0]
+    new = first_simulation.__class__(
+        compact_legislation = first_simulation.compact_legislation,
+        compact_legislation_getter = first_simulation.compact_legislation_getter,
+        date = first_simulation.date,
+        random_seed = first_simulation.random_seed,
+        tax_benefit_system = first_simulation.tax_benefit_system,
+        )
+    input_column_names_by_key_plural = collections.defaultdict(set)
+    for simulation in simulations:
+        assert simulation.steps_count == 1
+        assert simulation.tax_benefit_system is first_simulation.tax_benefit_system
+        assert simulation.date == first_simulation.date
+        assert simulation.compact_legislation is first_simulation.compact_legislation
+        assert simulation.random_seed == first_simulation.random_seed
+        for key_plural, entity in simulation.entity_by_key_plural.iteritems():
+            input_column_names_by_key_plural[key_plural].update(
+                column_name
+                for column_name, holder in entity.holder_by_name.iteritems()
+                if holder.array is not None and holder.kind is None
+                )
+
+    slices_by_key_plural = [{} for simulation in simulations]
+    for key_plural, new_entity in new.entity_by_key_plural.iteritems():
+        start = 0
+        for simulation, slice_by_key_plural in zip(simulations, slices_by_key_plural):
+            count = simulation.entity_by_key_plural[key_plural].count
+            slice_by_key_plural[key_plural] = slice(start, start + count)
+            start += count
+        new_entity.count = new_entity.step_size = start
+        new_entity.roles_count = max(
+            simulation.entity_by_key_plural[key_plural].roles_count
+            for simulation in simulations
+            )
+
+    group_key_plural_by_index_column_name = dict(
+        ('id' + entity.symbol, key_plural)
+        for key_plural, entity in new.entity_by_key_plural.iteritems()
+        if not entity.is_persons_entity
+        )
+    for key_plural, new_entity in new.entity_by_key_plural.iteritems():
+        for column_name in input_column_names_by_key_plural[key_plural]:
+            group_key_plural = group_key_plural_by_index_column_name.get(column_name) \
+                if new_entity.is_persons_entity else None
+            arrays = []
+            for simulation, slice_by_key_plural in zip(simulations, slices_by_key_plural):
+                # Use input array when given, else default or calculated value.
+                array = simulation.calculate(column_name)
+                if group_key_plural is not None:
+                    array = array + slice_by_key_plural[group_key_plural].start
+                arrays.append(array)
+            new_entity.get_or_new_holder(column_name).array = np.concatenate(arrays)
+    new.original_index_by_key_plural = dict(
+        (key_plural, np.concatenate([
+            simulation.get_original_index(new_entity.key_singular)
+            for simulation in simulations
+            ]))
+        for key_plural, new_entity in new.entity_by_key_plural.iteritems()
+        )
+    return new, slices_by_key_plural
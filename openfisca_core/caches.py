@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""On-disk cache of computed arrays, shared by the simulations of several runs"""
+
+
+import cPickle
+import hashlib
+import inspect
+import os
+import weakref
+
+import numpy as np
+
+from . import columns, formulas
+
+
+class ResultCache(object):
+    """Content-addressed cache of the arrays computed by formulas, stored in a directory (one .npy file per array).
+
+    The key of an array is a digest of the column name, of the input arrays (including the entities memberships) and
+    of the legislation parameters it depends on, and of the source code of the formulas involved. So an array is reused
+    only when the same formulas are run on the same inputs with the same legislation. When max_bytes is given, the
+    least recently used arrays are removed once the directory exceeds this size.
+
+    Formulas using other dates (or depending on such formulas) and select formulas are not cached, because the arrays
+    they read are not known in advance. Neither are formulas whose source code is not available. The keys of formulas
+    using "self" include the roles counts, the random seed and the original positions of members (used by random
+    streams).
+
+    To use a cache, set the result_cache attribute of a simulation.
+    """
+    digest_by_holder = None  # Cache of the digests of input arrays: (array, version, digest) triple by holder
+    directory = None
+    formulas_digest_by_column_name = None  # Cache of the digests of formulas source code
+    legislation_digest_by_id = None  # Cache of the digests of whole legislations: (legislation, digest) by id
+    max_bytes = None
+    original_index_digest_by_id = None  # Cache of the digests of original positions: (array, digest) by id
+
+    def __init__(self, directory, max_bytes = None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.digest_by_holder = weakref.WeakKeyDictionary()
+        self.directory = directory
+        self.formulas_digest_by_column_name = {}
+        self.legislation_digest_by_id = {}
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        self.original_index_digest_by_id = {}
+
+    def evict(self):
+        """Remove the least recently used arrays, until the size of the directory is below max_bytes."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # File removed by another process.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+    def get(self, key):
+        """Return the array stored for a key, or None."""
+        path = os.path.join(self.directory, key + '.npy')
+        try:
+            array = np.load(path)
+        except (IOError, ValueError):
+            return None
+        try:
+            # Mark array as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return array
+
+    def get_array_digest(self, holder):
+        array = holder.array
+        version = holder.version
+        cached = self.digest_by_holder.get(holder)
+        if cached is not None and cached[0] is array and cached[1] == version:
+            return cached[2]
+        column = holder.column
+        if isinstance(column, columns.StrCol):
+            # Codes of strings may differ between processes.
+            data = cPickle.dumps(column.decode(array).tolist(), 2)
+        elif array.dtype == object:
+            data = cPickle.dumps(array.tolist(), 2)
+        else:
+            data = np.ascontiguousarray(array)
+        digest = hashlib.sha1(data).hexdigest()
+        digest = '{}:{}:{}'.format(array.dtype.str, array.size, digest)
+        self.digest_by_holder[holder] = (array, version, digest)
+        return digest
+
+    def get_formulas_digest(self, column):
+        """Return the digest of the source code of the formulas of a column, or None when it is not available."""
+        formulas_digest_by_column_name = self.formulas_digest_by_column_name
+        if column.name in formulas_digest_by_column_name:
+            return formulas_digest_by_column_name[column.name]
+        formula_class = column.formula_constructor
+        hash_object = hashlib.sha1(column.name)
+        if issubclass(formula_class, formulas.DatedFormula):
+            hash_object.update(repr([
+                (dated_formula_class['start'], dated_formula_class['end'])
+                for dated_formula_class in formula_class.dated_formulas_class
+                ]))
+        digest = None
+        for simple_formula_class in formula_class.iter_simple_formula_classes():
+            try:
+                hash_object.update(inspect.getsource(simple_formula_class.function))
+            except (IOError, TypeError):
+                # Source code not available (for example a formula defined interactively): don't cache.
+                break
+        else:
+            digest = hash_object.hexdigest()
+        formulas_digest_by_column_name[column.name] = digest
+        return digest
+
+    def get_key(self, holder):
+        """Return the key of the array computed by the formula of a holder, or None when it can't be cached."""
+        column = holder.column
+        if isinstance(column, columns.StrCol):
+            # Codes of strings are not stable between processes.
+            return None
+        entity = holder.entity
+        simulation = entity.simulation
+        tax_benefit_system = simulation.tax_benefit_system
+        column_by_name = tax_benefit_system.column_by_name
+        hash_object = hashlib.sha1(column.name)
+        hash_object.update(repr(sorted(
+            (key_plural, other_entity.count)
+            for key_plural, other_entity in simulation.entity_by_key_plural.iteritems()
+            )))
+        # Memberships of persons are used implicitly by formulas working on roles.
+        persons = simulation.persons
+        for other_entity in sorted(simulation.entity_by_key_plural.itervalues(), key = lambda entity: entity.symbol):
+            if other_entity.is_persons_entity:
+                continue
+            for prefix in ('id', 'qui'):
+                membership_holder = persons.holder_by_name.get(prefix + other_entity.symbol)
+                if membership_holder is not None and membership_holder.array is not None:
+                    hash_object.update(self.get_array_digest(membership_holder))
+        uses_date = False
+        uses_self = False
+        for column_name in sorted(tax_benefit_system.get_dependencies_closure([column.name]).union([column.name])):
+            hash_object.update(column_name)
+            dependency_column = column_by_name[column_name]
+            if dependency_column.start is not None or dependency_column.end is not None:
+                uses_date = True
+            dependency_holder = simulation.get_holder(column_name, None)
+            if dependency_holder is not holder and dependency_holder is not None and dependency_holder.kind is None \
+                    and dependency_holder.array is not None:
+                hash_object.update(self.get_array_digest(dependency_holder))
+                continue
+            formula_class = dependency_column.formula_constructor
+            if formula_class is None:
+                continue
+            if issubclass(formula_class, formulas.SelectFormula):
+                # The main variables used to select a formula are not in the dependencies.
+                return None
+            if issubclass(formula_class, formulas.DatedFormula):
+                uses_date = True
+            formulas_digest = self.get_formulas_digest(dependency_column)
+            if formulas_digest is None:
+                return None
+            hash_object.update(formulas_digest)
+            for simple_formula_class in formula_class.iter_simple_formula_classes():
+                if simple_formula_class.requires_other_dates:
+                    # The arrays read at other dates are not in the dependencies.
+                    return None
+                if simple_formula_class.requires_self:
+                    # Through "self", a function may use roles, random streams and the date of the simulation.
+                    uses_date = True
+                    uses_self = True
+                if simple_formula_class.requires_default_legislation:
+                    hash_object.update(self.get_legislation_digest(simulation.default_compact_legislation))
+                if simple_formula_class.requires_legislation:
+                    hash_object.update(self.get_legislation_digest(simulation.compact_legislation))
+                if simple_formula_class.legislation_accessor_by_name is not None:
+                    for name, legislation_accessor in sorted(
+                            simple_formula_class.legislation_accessor_by_name.iteritems()):
+                        hash_object.update(name)
+                        for part in iter_fingerprint_parts(legislation_accessor(simulation.compact_legislation,
+                                default = None)):
+                            hash_object.update(part)
+        if uses_date:
+            hash_object.update(simulation.date.isoformat())
+        if uses_self:
+            hash_object.update(repr(sorted(
+                (key_plural, other_entity.roles_count)
+                for key_plural, other_entity in simulation.entity_by_key_plural.iteritems()
+                )))
+            hash_object.update(repr(simulation.random_seed))
+            for key_plural in sorted(simulation.entity_by_key_plural):
+                hash_object.update(self.get_original_index_digest(
+                    simulation.get_original_index(simulation.entity_by_key_plural[key_plural].key_singular)))
+        return hash_object.hexdigest()
+
+    def get_legislation_digest(self, compact_legislation):
+        cached = self.legislation_digest_by_id.get(id(compact_legislation))
+        if cached is not None and cached[0] is compact_legislation:
+            return cached[1]
+        hash_object = hashlib.sha1()
+        for part in iter_fingerprint_parts(compact_legislation):
+            hash_object.update(part)
+        digest = hash_object.hexdigest()
+        self.legislation_digest_by_id[id(compact_legislation)] = (compact_legislation, digest)
+        return digest
+
+    def get_original_index_digest(self, original_index):
+        cached = self.original_index_digest_by_id.get(id(original_index))
+        if cached is not None and cached[0] is original_index:
+            return cached[1]
+        digest = hashlib.sha1(np.ascontiguousarray(original_index, dtype = np.int64)).hexdigest()
+        self.original_index_digest_by_id[id(original_index)] = (original_index, digest)
+        return digest
+
+    def put(self, key, array):
+        """Store the array of a key, then evict the least recently used arrays when needed."""
+        path = os.path.join(self.directory, key + '.npy')
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'wb') as array_file:
+            np.save(array_file, array)
+        # Renaming is atomic, so that other processes never read a partial file.
+        os.rename(temporary_path, path)
+        if self.max_bytes is not None:
+            self.evict()
+
+
+def iter_fingerprint_parts(value):
+    """Iterate over strings describing a legislation value (a node, a tax scale, a parameter...)."""
+    if isinstance(value, np.ndarray):
+        yield value.dtype.str
+        yield np.ascontiguousarray(value).tostring()
+    elif isinstance(value, (list, tuple)):
+        yield '['
+        for item in value:
+            for part in iter_fingerprint_parts(item):
+                yield part
+        yield ']'
+    elif isinstance(value, dict):
+        # Checked before __dict__, because subclasses of dict (like TaxScaleDict) have both.
+        yield value.__class__.__name__
+        yield '{'
+        for key, item in sorted(value.iteritems()):
+            for part in iter_fingerprint_parts(key):
+                yield part
+            for part in iter_fingerprint_parts(item):
+                yield part
+        yield '}'
+        if getattr(value, '__dict__', None):
+            for part in iter_fingerprint_parts(value.__dict__):
+                yield part
+    elif hasattr(value, '__dict__'):
+        yield value.__class__.__name__
+        yield '{'
+        for key, item in sorted(value.__dict__.iteritems()):
+            yield key
+            for part in iter_fingerprint_parts(item):
+                yield part
+        yield '}'
+    else:
+        yield repr(value)
@@ -26,6 +26,7 @@
 import collections
 import datetime
 import re
+import threading
 
 from biryani1 import strings
 import numpy as np
@@ -210,11 +211,79 @@ class IntCol(Column):
         return conv.test_isinstance(int)
 
 
+categories_lock = threading.Lock()  # Protects the growth of the categories of StrCol columns shared by threads
+
+
 class StrCol(Column):
-    default = u''
-    dtype = object
+    '''
+    A column of strings, stored as integer codes of a table of categories
+
+    The categories are shared by all the simulations using the column and only grow during the life of the process.
+    Arrays contain codes, not strings: compare them to strings using methods equal & isin.
+    '''
+    categories = None  # List of strings, indexed by their code
+    default = 0  # Code of the default string
+    dtype = np.int32
+    index_by_category = None
     json_type = 'String'
 
+    def __init__(self, default = None, **kwargs):
+        super(StrCol, self).__init__(**kwargs)
+        self.categories = [u'']
+        self.index_by_category = {u'': 0}
+        if default is not None:
+            self.default = self.encode_value(default)
+
+    def decode(self, codes):
+        """Convert an array of codes to an array of strings."""
+        return np.array(self.categories, dtype = object)[codes]
+
+    def encode(self, values):
+        """Convert an array of strings to an array of codes, adding the new strings to the categories.
+
+        An array that doesn't contain strings (nor objects) is considered as already containing codes, which must be
+        known categories (for example survey values like 75056 must be given as strings).
+        """
+        values = np.asarray(values)
+        if values.dtype.kind not in 'OSU':
+            codes = values.astype(self.dtype)
+            if codes.size and (codes.min() < 0 or codes.max() >= len(self.categories) or np.any(codes != values)):
+                raise ValueError(u"Column {} expects strings or codes of its {} categories. Got: {}".format(
+                    self.name, len(self.categories), values).encode('utf-8'))
+            return codes
+        unique_values, inverse = np.unique(values.astype(object), return_inverse = True)
+        unique_codes = np.array([self.encode_value(value) for value in unique_values], dtype = self.dtype)
+        return unique_codes[inverse]
+
+    def encode_value(self, value):
+        index_by_category = self.index_by_category
+        code = index_by_category.get(value)
+        if code is None:
+            with categories_lock:
+                code = index_by_category.get(value)
+                if code is None:
+                    categories = self.categories
+                    code = len(categories)
+                    # Append category before indexing it, for the readers that don't take the lock.
+                    categories.append(value)
+                    index_by_category[value] = code
+        return code
+
+    def equal(self, codes, value):
+        """Return a boolean array telling which codes correspond to the given string."""
+        return codes == self.index_by_category.get(value, -1)
+
+    def isin(self, codes, values):
+        """Return a boolean array telling which codes correspond to one of the given strings."""
+        return np.in1d(codes, [
+            self.index_by_category[value]
+            for value in values
+            if value in self.index_by_category
+            ])
+
+    def json_default(self):
+        return self.categories[self.default]
+
     @property
     def json_to_python(self):
         return conv.test_isinstance(basestring)
@@ -23,6 +23,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import numpy as np
+
 from . import holders
 
 
@@ -33,6 +35,7 @@ class AbstractEntity(object):
     key_plural = None
     key_singular = None
     is_persons_entity = False
+    members_offsets_cache = None  # Index & role arrays with their holders versions, and result of get_members_offsets()
     roles_count = None  # Not used for individus
     step_size = 0
     simulation = None
@@ -52,6 +55,8 @@ class AbstractEntity(object):
         new = self.__class__(simulation = simulation)
         new.column_by_name = self.column_by_name
         new.count = self.count
+        new.roles_count = self.roles_count
+        new.step_size = self.step_size
         new.holder_by_name.update(
             (name, holder.copy_for_entity(new))
             for name, holder in self.holder_by_name.iteritems()
@@ -67,5 +72,35 @@ class AbstractEntity(object):
                 holder.formula = column.formula_constructor(holder = holder)
         return holder
 
+    def get_members_offsets(self):
+        """Return the position of the first member of each group entity, followed by the count of persons.
+
+        Returns None, unless persons are sorted by group (see Simulation.sort_persons), every group has members and
+        the members of a group have distinct roles.
+        """
+        assert not self.is_persons_entity
+        persons = self.simulation.persons
+        index_holder = persons.holder_by_name['id' + self.symbol]
+        index_array = index_holder.array
+        role_holder = persons.holder_by_name['qui' + self.symbol]
+        role_array = role_holder.array
+        members_offsets_cache = self.members_offsets_cache
+        if members_offsets_cache is not None and members_offsets_cache[0] is index_array \
+                and members_offsets_cache[1] == index_holder.version and members_offsets_cache[2] is role_array \
+                and members_offsets_cache[3] == role_holder.version:
+            return members_offsets_cache[4]
+        members_offsets = None
+        if index_array.size > 0 and np.all(index_array[1:] >= index_array[:-1]):
+            members_count = np.bincount(index_array, minlength = self.count)
+            if members_count.size == self.count and np.all(members_count > 0):
+                # Sums by role are accumulated role after role (see SimpleFormula.sum_by_entity), like when persons
+                # are not sorted, which requires distinct roles in each group.
+                roles_key = index_array.astype(np.int64) * (int(role_array.max()) + 1) + role_array
+                if np.unique(roles_key).size == roles_key.size:
+                    members_offsets = np.concatenate(([0], np.cumsum(members_count)))
+        self.members_offsets_cache = (index_array, index_holder.version, role_array, role_holder.version,
+            members_offsets)
+        return members_offsets
+
     def graph(self, column_name, edges, nodes, visited):
         self.get_or_new_holder(column_name).graph(edges, nodes, visited)
@@ -29,7 +29,7 @@ import logging
 
 import numpy as np
 
-from . import accessors, holders
+from . import accessors, columns, holders, legislations
 
 
 log = logging.getLogger(__name__)
@@ -115,7 +115,6 @@ class AlternativeFormula(AbstractGroupedFormula):
             array = alternative_formula.calculate(lazy = True, requested_formulas = requested_formulas.copy())
             if array is not None:
                 self.used_formula = alternative_formula
-                holder.array = array
                 requested_formulas.remove(self)
                 return array
         if lazy:
@@ -125,7 +124,7 @@ class AlternativeFormula(AbstractGroupedFormula):
         # TODO: Imagine a better strategy.
         alternative_formula = self.alternative_formulas[0]
         self.used_formula = alternative_formula
-        holder.array = array = alternative_formula.calculate(lazy = False, requested_formulas = requested_formulas)
+        array = alternative_formula.calculate(lazy = False, requested_formulas = requested_formulas)
         requested_formulas.remove(self)
         return array
 
@@ -134,6 +133,19 @@ class AlternativeFormula(AbstractGroupedFormula):
         for alternative_formula in self.alternative_formulas:
             alternative_formula.graph_parameters(edges, nodes, visited)
 
+    @classmethod
+    def is_date_dependent(cls):
+        return any(
+            alternative_formula_constructor.is_date_dependent()
+            for alternative_formula_constructor in cls.alternative_formulas_constructor
+            )
+
+    @classmethod
+    def iter_simple_formula_classes(cls):
+        for alternative_formula_constructor in cls.alternative_formulas_constructor:
+            for simple_formula_class in alternative_formula_constructor.iter_simple_formula_classes():
+                yield simple_formula_class
+
     @classmethod
     def set_dependencies(cls, column, column_by_name):
         for alternative_formula_constructor in cls.alternative_formulas_constructor:
@@ -197,12 +209,12 @@ class DatedFormula(AbstractGroupedFormula):
                 array = dated_formula['formula'].calculate(lazy = lazy, requested_formulas = requested_formulas)
                 if array is not None:
                     self.used_formula = dated_formula['formula']
-                    holder.array = array
                     requested_formulas.remove(self)
                     return array
 
         holder.array = np.empty(entity.count, dtype = column.dtype)
         holder.array.fill(column.default)
+        holder.kind = u'default'
         requested_formulas.remove(self)
         return holder.array
 
@@ -211,6 +223,17 @@ class DatedFormula(AbstractGroupedFormula):
         for dated_formula in self.dated_formulas:
             dated_formula['formula'].graph_parameters(edges, nodes, visited)
 
+    @classmethod
+    def is_date_dependent(cls):
+        # Selection of the dated formula depends on date.
+        return True
+
+    @classmethod
+    def iter_simple_formula_classes(cls):
+        for dated_formula_class in cls.dated_formulas_class:
+            for simple_formula_class in dated_formula_class['formula_class'].iter_simple_formula_classes():
+                yield simple_formula_class
+
     @classmethod
     def set_dependencies(cls, column, column_by_name):
         for dated_formula_class in cls.dated_formulas_class:
@@ -276,7 +299,7 @@ class SelectFormula(AbstractGroupedFormula):
         else:
             selected_formula = self.formula_by_main_variable.values()[0]
         self.used_formula = selected_formula
-        holder.array = array = selected_formula.calculate(lazy = lazy, requested_formulas = requested_formulas)
+        array = selected_formula.calculate(lazy = lazy, requested_formulas = requested_formulas)
         requested_formulas.remove(self)
         return array
 
@@ -285,6 +308,19 @@ class SelectFormula(AbstractGroupedFormula):
         for formula in self.formula_by_main_variable.itervalues():
             formula.graph_parameters(edges, nodes, visited)
 
+    @classmethod
+    def is_date_dependent(cls):
+        return any(
+            formula_constructor.is_date_dependent()
+            for formula_constructor in cls.formula_constructor_by_main_variable.itervalues()
+            )
+
+    @classmethod
+    def iter_simple_formula_classes(cls):
+        for formula_constructor in cls.formula_constructor_by_main_variable.itervalues():
+            for simple_formula_class in formula_constructor.iter_simple_formula_classes():
+                yield simple_formula_class
+
     @classmethod
     def set_dependencies(cls, column, column_by_name):
         for formula_constructor in cls.formula_constructor_by_main_variable.itervalues():
@@ -307,7 +343,9 @@ class SimpleFormula(AbstractFormula):
     parameters = None  # class attribute
     requires_default_legislation = False  # class attribute
     requires_legislation = False  # class attribute
+    requires_other_dates = False  # class attribute. True when function uses self.calculate_at_date()
     requires_self = False  # class attribute
+    requested_formulas = None  # Formulas being calculated while function is called (used by calculate_at_date)
 
     def __init__(self, holder = None):
         super(SimpleFormula, self).__init__(holder = holder)
@@ -340,6 +378,12 @@ class SimpleFormula(AbstractFormula):
                 'utf-8')
             assert array.size == persons.count, u"Expected an array of size {}. Got: {}".format(persons.count,
                 array.size)
+        members_offsets = entity.get_members_offsets()
+        if members_offsets is not None:
+            # Persons are sorted by entity: use a contiguous reduction.
+            roles_filter = get_roles_filter(persons.holder_by_name['qui' + entity.symbol].array, entity.roles_count,
+                roles)
+            return np.logical_or.reduceat(np.logical_and(array, roles_filter), members_offsets[:-1])
         entity_index_array = persons.holder_by_name['id' + entity.symbol].array
         if roles is None:
             roles = range(entity.roles_count)
@@ -399,9 +443,13 @@ class SimpleFormula(AbstractFormula):
         if self.requires_default_legislation:
             required_parameters.add('_defaultP')
             arguments['_defaultP'] = simulation.default_compact_legislation
+        legislation_paths_by_column_name = simulation.legislation_paths_by_column_name
+        if legislation_paths_by_column_name is not None:
+            legislation_paths = legislation_paths_by_column_name.setdefault(column.name, set())
         if self.requires_legislation:
             required_parameters.add('_P')
-            arguments['_P'] = simulation.compact_legislation
+            arguments['_P'] = simulation.compact_legislation if legislation_paths_by_column_name is None \
+                else legislations.RecordingCompactNode(simulation.compact_legislation, legislation_paths)
         if self.requires_self:
             required_parameters.add('self')
             arguments['self'] = self
@@ -409,17 +457,27 @@ class SimpleFormula(AbstractFormula):
             for name, legislation_accessor in self.legislation_accessor_by_name.iteritems():
                 # TODO: Also handle simulation.default_compact_legislation
                 arguments[name] = legislation_accessor(simulation.compact_legislation, default = None)
+                if legislation_paths_by_column_name is not None:
+                    legislation_paths.add(tuple(
+                        ancestor.name
+                        for ancestor in reversed(list(legislation_accessor.iter_ancestors()))
+                        ))
 
         provided_parameters = set(arguments.keys())
         assert provided_parameters == required_parameters, 'Formula {} requires missing parameters : {}'.format(
             u', '.join(sorted(required_parameters - provided_parameters)).encode('utf-8'))
 
+        # A formula may be called again (at another date) by its own function.
+        outer_requested_formulas = self.requested_formulas
+        self.requested_formulas = requested_formulas
         try:
             array = self.function(**arguments)
         except:
             log.error(u'An error occurred while calling function {}@{}({})'.format(entity.key_plural, column.name,
                 self.get_arguments_str()))
             raise
+        finally:
+            self.requested_formulas = outer_requested_formulas
         assert isinstance(array, np.ndarray), u"Function {}@{}({}) doesn't return a numpy array, but: {}".format(
             entity.key_plural, column.name, self.get_arguments_str(), array).encode('utf-8')
         assert array.size == entity.count, \
@@ -434,10 +492,11 @@ class SimpleFormula(AbstractFormula):
                 pass
 
         if array.dtype != column.dtype:
-            array = array.astype(column.dtype)
+            array = column.encode(array) if isinstance(column, columns.StrCol) else array.astype(column.dtype)
         if simulation.debug and (simulation.debug_all or not has_only_default_arguments):
             log.info(u'<=> {}@{}({}) --> {}'.format(entity.key_plural, column.name, self.get_arguments_str(), array))
         holder.array = array
+        holder.kind = u'computed'
         if simulation.trace:
             simulation.traceback[column.name].update(dict(
                 default_arguments = has_only_default_arguments,
@@ -447,6 +506,16 @@ class SimpleFormula(AbstractFormula):
 
         return array
 
+    def calculate_at_date(self, column_name, date):
+        """Return the array of a column at another date (aka period).
+
+        Only formulas declaring requires_other_dates may use it, so that they are known to be date dependent.
+        """
+        assert self.requires_other_dates, u"Formula {} must set requires_other_dates to use other dates".format(
+            self.holder.column.name).encode('utf-8')
+        return self.holder.entity.simulation.calculate(column_name, date = date,
+            requested_formulas = self.requested_formulas)
+
     def cast_from_entity_to_role(self, array_or_holder, default = None, entity = None, role = None):
         """Cast an entity array to a persons array, setting only cells of persons having the given role."""
         assert isinstance(role, int)
@@ -483,6 +552,13 @@ class SimpleFormula(AbstractFormula):
             if default is None:
                 default = 0
         assert not entity.is_persons_entity
+        members_offsets = entity.get_members_offsets()
+        if members_offsets is not None:
+            # Persons are sorted by entity: use a contiguous repetition.
+            roles_filter = get_roles_filter(persons.holder_by_name['qui' + entity.symbol].array, entity.roles_count,
+                roles)
+            return np.where(roles_filter, np.repeat(array, np.diff(members_offsets)),
+                np.array(default, dtype = array.dtype))
         target_array = np.empty(persons.count, dtype = array.dtype)
         target_array.fill(default)
         entity_index_array = persons.holder_by_name['id' + entity.symbol].array
@@ -522,6 +598,8 @@ class SimpleFormula(AbstractFormula):
         if 'self' in parameters:
             cls.requires_self = True
             parameters.remove('self')
+        assert cls.requires_self or not cls.requires_other_dates, \
+            'Function {} must use self to read values at other dates'.format(function.__name__)
 
     def filter_role(self, array_or_holder, default = None, entity = None, role = None):
         """Convert a persons array to an entity array, copying only cells of persons having the given role."""
@@ -566,6 +644,15 @@ class SimpleFormula(AbstractFormula):
             for parameter, parameter_holder in self.holder_by_parameter.iteritems()
             )
 
+    def get_random(self, draw = 0, entity = None):
+        """Return reproducible uniform random numbers in [0, 1) for the members of an entity (default: formula one).
+
+        See Simulation.get_random.
+        """
+        holder = self.holder
+        return holder.entity.simulation.get_random(holder.column.name, draw = draw,
+            entity = holder.entity.key_singular if entity is None else entity)
+
     def graph_parameters(self, edges, nodes, visited):
         """Recursively build a graph of formulas."""
         holder = self.holder
@@ -579,6 +666,19 @@ class SimpleFormula(AbstractFormula):
                 'to': column.name,
                 })
 
+    @classmethod
+    def is_date_dependent(cls):
+        """Return whether the function reads the (dated) legislation or the values of other dates.
+
+        The legislation that may be accessed through "self" is not taken into account.
+        """
+        return cls.requires_default_legislation or cls.requires_legislation or cls.requires_other_dates \
+            or cls.legislation_accessor_by_name is not None
+
+    @classmethod
+    def iter_simple_formula_classes(cls):
+        yield cls
+
     @property
     def real_formula(self):
         return self
@@ -654,10 +754,22 @@ class SimpleFormula(AbstractFormula):
                 'utf-8')
             assert array.size == persons.count, u"Expected an array of size {}. Got: {}".format(persons.count,
                 array.size)
+        target_dtype = array.dtype if array.dtype != np.bool else np.int16
+        members_offsets = entity.get_members_offsets()
+        if members_offsets is not None:
+            # Persons are sorted by entity: use contiguous reductions. Each group has at most one member by role, so
+            # adding role after role gives the same (floating point) sums as the loop below.
+            roles_array = persons.holder_by_name['qui' + entity.symbol].array
+            zero = np.zeros(1, dtype = target_dtype)
+            target_array = np.zeros(entity.count, dtype = target_dtype)
+            for role in (range(entity.roles_count) if roles is None else roles):
+                target_array += np.add.reduceat(np.where(roles_array == role, array, zero),
+                    members_offsets[:-1]).astype(target_dtype)
+            return target_array
         entity_index_array = persons.holder_by_name['id' + entity.symbol].array
         if roles is None:
             roles = range(entity.roles_count)
-        target_array = np.zeros(entity.count, dtype = array.dtype if array.dtype != np.bool else np.int16)
+        target_array = np.zeros(entity.count, dtype = target_dtype)
         for role in roles:
             # TODO: Mettre les filtres en cache dans la simulation
             boolean_filter = persons.holder_by_name['qui' + entity.symbol].array == role
@@ -686,3 +798,16 @@ class SimpleFormula(AbstractFormula):
             ('parameters', parameters_json),
             ('source', ''.join(source_lines).decode('utf-8')),
             ))
+
+
+# Functions
+
+
+def get_roles_filter(roles_array, roles_count, roles = None):
+    """Return the boolean filter of persons having one of the given roles (default: any role below roles_count)."""
+    if roles is None:
+        return roles_array < roles_count
+    roles_filter = np.zeros(roles_array.shape, dtype = bool)
+    for role in roles:
+        roles_filter |= roles_array == role
+    return roles_filter
@@ -32,9 +32,12 @@ from . import columns
 
 class Holder(object):
     _array = None
+    array_by_date = None  # (array, kind) couples of the other dates, for a date-dependent holder
     column = None
     entity = None
     formula = None
+    kind = None  # None when array is an input, u'computed' or u'default' when array is filled by holder
+    version = 0  # Incremented each time array is changed
 
     def __init__(self, column = None, entity = None):
         assert column is not None
@@ -52,7 +55,12 @@ class Holder(object):
         simulation = self.entity.simulation
         if simulation.trace:
             simulation.traceback.pop(self.column.name, None)
+        array = self._array
+        if array is not None:
+            simulation.arrays_bytes -= array.nbytes
         del self._array
+        self.kind = None
+        self.version += 1
 
     @array.setter
     def array(self, array):
@@ -64,7 +72,21 @@ class Holder(object):
                 simulation.traceback[name] = dict(
                     holder = self,
                     )
+        column = self.column
+        if array is not None and array.dtype != column.dtype and isinstance(column, columns.StrCol):
+            # Convert strings (coming from JSON or survey data) to their codes, and other integers to codes dtype.
+            array = column.encode(array)
+        old_array = self._array
+        if old_array is not None:
+            simulation.arrays_bytes -= old_array.nbytes
+        if array is not None:
+            simulation.arrays_bytes += array.nbytes
+            if simulation.arrays_bytes > simulation.peak_arrays_bytes:
+                simulation.peak_arrays_bytes = simulation.arrays_bytes
         self._array = array
+        # An assigned array is an input, unless the caller (formula, cache...) sets kind afterwards.
+        self.kind = None
+        self.version += 1
 
     def calculate(self, lazy = False, requested_formulas = None):
         column = self.column
@@ -75,14 +97,63 @@ class Holder(object):
             if not lazy and self.array is None:
                 self.array = np.empty(self.entity.count, dtype = column.dtype)
                 self.array.fill(column.default)
+                self.kind = u'default'
             return self.array
+        result_cache = self.entity.simulation.result_cache
+        if result_cache is not None and not lazy and self.array is None:
+            key = result_cache.get_key(self)
+            if key is not None:
+                array = result_cache.get(key)
+                if array is not None:
+                    self.array = array
+                    self.kind = u'computed'
+                    return array
+                array = formula.calculate(requested_formulas = requested_formulas)
+                if self.kind == u'computed':
+                    result_cache.put(key, array)
+                return array
         return formula.calculate(lazy = lazy, requested_formulas = requested_formulas)
 
     def copy_for_entity(self, entity):
         new = self.__class__(column = self.column, entity = entity)
-        new.array = self.array
+        array = self.array
+        if array is not None:
+            # Array is shared by both holders => Protect it against in-place modifications. Use
+            # get_writable_array() to get a private copy (aka copy-on-write).
+            array.setflags(write = False)
+        new.array = array
+        new.kind = self.kind
+        if self.array_by_date:
+            new.array_by_date = self.array_by_date.copy()
+            for array, kind in new.array_by_date.itervalues():
+                array.setflags(write = False)
+                entity.simulation.arrays_bytes += array.nbytes
         return new
 
+    def delete_arrays_by_date(self, computed_only = False):
+        """Forget the arrays of the dates other than the current date of the simulation.
+
+        When computed_only is True, the input arrays are kept.
+        """
+        array_by_date = self.array_by_date
+        if not array_by_date:
+            return
+        simulation = self.entity.simulation
+        for date, (array, kind) in array_by_date.items():
+            if computed_only and kind is None:
+                continue
+            simulation.arrays_bytes -= array.nbytes
+            del array_by_date[date]
+
+    def get_writable_array(self):
+        """Return the array of holder, copying it first when it is read-only (ie shared with another simulation)."""
+        array = self.array
+        if array is not None and not array.flags.writeable:
+            kind = self.kind
+            self.array = array = array.copy()
+            self.kind = kind
+        return array
+
     def graph(self, edges, nodes, visited):
         column = self.column
         if self in visited:
@@ -115,6 +186,16 @@ class Holder(object):
             return None
         return formula.real_formula
 
+    def set_date(self, date):
+        """Keep the array of the current date of the simulation and restore the array of the given date."""
+        array_by_date = self.array_by_date
+        if array_by_date is None:
+            self.array_by_date = array_by_date = {}
+        if self._array is not None:
+            array_by_date[self.entity.simulation.date] = (self._array, self.kind)
+        self._array, self.kind = array_by_date.pop(date, (None, None))
+        self.version += 1
+
     def to_json(self, with_array = False):
         self_json = self.column.to_json()
         self_json['entity'] = self.entity.key_plural  # Override entity symbol given by column. TODO: Remove.
@@ -134,5 +215,8 @@ class Holder(object):
                 )))
 
         if with_array and self.array is not None:
-            self_json['array'] = self.array.tolist()
+            array = self.array
+            if isinstance(self.column, columns.StrCol):
+                array = self.column.decode(array)
+            self_json['array'] = array.tolist()
         return self_json
@@ -35,6 +35,7 @@ from taxscales import TaxScale
 
 
 N_ = lambda message: message
+scalar_types = (basestring, bool, datetime.date, float, int, long, type(None))
 units = [
     u'currency',
     u'day',
@@ -52,6 +53,27 @@ class CompactNode(object):
         return 'CompactNode({})'.format(repr(self.__dict__))
 
 
+class RecordingCompactNode(object):
+    """Wrapper of a compact node that records the paths of the parameters read through it."""
+    __slots__ = ('_compact_node', '_path', '_paths')
+
+    def __init__(self, compact_node, paths, path = ()):
+        self._compact_node = compact_node
+        self._path = path
+        self._paths = paths
+
+    def __getattr__(self, name):
+        value = getattr(self._compact_node, name)
+        path = self._path + (name,)
+        if isinstance(value, CompactNode):
+            return RecordingCompactNode(value, self._paths, path = path)
+        self._paths.add(path)
+        return value
+
+    def __repr__(self):
+        return 'RecordingCompactNode({})'.format(repr(self._compact_node))
+
+
 # Functions
 
 
@@ -84,6 +106,27 @@ def compact_dated_node_json(dated_node_json, code = None):
     return tax_scale
 
 
+def iter_changed_paths(compact_node, other_compact_node, path = ()):
+    """Iterate over the paths of the parameters that differ between two compact legislations.
+
+    Parameters that are not scalars (tax scales, dictionaries, etc) are considered as changed unless they are the same
+    object, because their comparison operators don't compare all their attributes.
+    """
+    node_dict = compact_node.__dict__
+    other_node_dict = other_compact_node.__dict__
+    for key in set(node_dict).union(other_node_dict):
+        value = node_dict.get(key)
+        other_value = other_node_dict.get(key)
+        if value is other_value:
+            continue
+        if isinstance(value, CompactNode) and isinstance(other_value, CompactNode):
+            for changed_path in iter_changed_paths(value, other_value, path = path + (key,)):
+                yield changed_path
+        elif not isinstance(value, scalar_types) or not isinstance(other_value, scalar_types) \
+                or value != other_value:
+            yield path + (key,)
+
+
 def generate_dated_json_value(values_json, date_str, legislation_from_str, legislation_to_str):
     max_to_str = None
     max_value = None
@@ -208,6 +251,19 @@ def make_validate_values_json_dates(require_consecutive_dates = False):
     return validate_values_json_dates
 
 
+def patch_compact_node(compact_node, path, value):
+    """Return a copy of a compact node where the parameter at the given path has a new value.
+
+    Only the nodes along the path are copied, the other ones are shared with the original compact node.
+    """
+    new_compact_node = CompactNode()
+    new_compact_node.__dict__.update(compact_node.__dict__)
+    name = path[0]
+    new_compact_node.__dict__[name] = value if len(path) == 1 \
+        else patch_compact_node(getattr(compact_node, name), path[1:], value)
+    return new_compact_node
+
+
 def validate_dated_legislation_json(dated_legislation_json, state = None):
     if dated_legislation_json is None:
         return None, None
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run the same simulation for several dates, calculating the date-invariant columns only once."""
+
+
+import multiprocessing
+
+from . import shards
+
+
+# Globals of worker processes
+worker_column_names = None
+worker_simulation = None
+
+
+def _calculate_date(date):
+    worker_simulation.set_date(date, keep_computed_arrays = False)
+    return shards.calculate_arrays(worker_simulation, worker_column_names)
+
+
+def _initialize_worker(simulation, column_names):
+    global worker_column_names, worker_simulation
+    worker_column_names = column_names
+    worker_simulation = simulation
+
+
+def calculate_by_dates(simulation, column_names, dates, processes_count = None):
+    """Calculate columns for each date and return their arrays by date.
+
+    The date-invariant columns needed are calculated once, then the date-dependent ones are calculated for each date.
+    When processes_count is given, dates are calculated in parallel by forked processes (POSIX only), which share the
+    (read-only) arrays of the date-invariant columns.
+
+    Calculations are done in a fork of the simulation, which is left unchanged (except that its arrays become shared,
+    see Simulation.fork).
+    """
+    simulation = simulation.fork()
+    invariant_column_names, dependent_column_names = plan(simulation, column_names)
+    for column_name in invariant_column_names:
+        simulation.calculate(column_name)
+    invariant_array_by_column_name = shards.calculate_arrays(simulation,
+        set(column_names).intersection(invariant_column_names))
+    dependent_column_names = [
+        column_name
+        for column_name in column_names
+        if column_name in dependent_column_names
+        ]
+
+    if processes_count is None:
+        dependent_arrays = []
+        for date in dates:
+            simulation.set_date(date, keep_computed_arrays = False)
+            dependent_arrays.append(shards.calculate_arrays(simulation, dependent_column_names))
+    else:
+        for entity in simulation.entity_by_key_plural.itervalues():
+            for holder in entity.holder_by_name.itervalues():
+                if holder.array is not None:
+                    holder.array.setflags(write = False)
+        pool = multiprocessing.Pool(processes_count, initializer = _initialize_worker,
+            initargs = (simulation, dependent_column_names))
+        try:
+            dependent_arrays = pool.map(_calculate_date, dates)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    array_by_column_name_by_date = {}
+    for date, dependent_array_by_column_name in zip(dates, dependent_arrays):
+        array_by_column_name_by_date[date] = array_by_column_name = invariant_array_by_column_name.copy()
+        array_by_column_name.update(dependent_array_by_column_name)
+    return array_by_column_name_by_date
+
+
+def plan(simulation, column_names):
+    """Split the columns needed to calculate the given ones into date-invariant and date-dependent columns."""
+    needed_column_names = set(column_names).union(
+        simulation.tax_benefit_system.get_dependencies_closure(column_names))
+    date_dependent_column_names = simulation.get_date_dependent_column_names()
+    return needed_column_names - date_dependent_column_names, needed_column_names & date_dependent_column_names
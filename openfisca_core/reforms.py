@@ -23,6 +23,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import numpy as np
+
+from . import legislations
+
+
 class Reform():
     name = None
     legislation_json_patch = None
@@ -32,3 +37,145 @@ class Reform():
             self.name = name
         if legislation_json_patch is not None:
             self.legislation_json_patch = legislation_json_patch
+
+
+class ReformComparison(object):
+    """Comparison of a simulation with the same simulation using a reformed legislation.
+
+    The baseline simulation records the legislation paths read by each formula (see option record_legislation_paths of
+    Simulation). The reform simulation shares the baseline arrays of every column that doesn't depend (directly or
+    indirectly) on a changed parameter, and only recomputes the other ones.
+
+    Formulas using other dates need reform_compact_legislation_getter, giving the reform legislation of a date (see
+    Simulation.set_date). As only the parameters changed at the current date are known, these formulas are always
+    considered as affected by the reform.
+    """
+    baseline = None  # Simulation using the baseline legislation
+    changed_paths = None  # Paths of the parameters that differ between baseline and reform legislations
+    reform = None  # Simulation using the reform legislation
+
+    def __init__(self, simulation, reform_compact_legislation, reform_compact_legislation_getter = None):
+        legislation_paths_by_column_name = simulation.legislation_paths_by_column_name
+        if legislation_paths_by_column_name is None:
+            simulation.legislation_paths_by_column_name = legislation_paths_by_column_name = {}
+        # The date-dependent arrays computed before recording was enabled would all be considered as affected by the
+        # reform: forget them, so that baseline recomputes them while recording their legislation paths.
+        date_dependent_column_names = simulation.get_date_dependent_column_names()
+        for entity in simulation.entity_by_key_plural.itervalues():
+            for column_name, holder in entity.holder_by_name.iteritems():
+                if column_name in date_dependent_column_names and holder.kind == u'computed' \
+                        and holder.array is not None and column_name not in legislation_paths_by_column_name:
+                    del holder.array
+        self.baseline = simulation
+        self.changed_paths = set(legislations.iter_changed_paths(simulation.compact_legislation,
+            reform_compact_legislation))
+        self.reform = simulation.fork(compact_legislation = reform_compact_legislation,
+            compact_legislation_getter = reform_compact_legislation_getter)
+
+    def calculate(self, column_name):
+        """Return the baseline array, the reform array and their difference (None when not numeric) of a column."""
+        baseline = self.baseline
+        reform = self.reform
+        baseline_array = baseline.calculate(column_name)
+        affected_column_names = self.get_affected_column_names()
+        tax_benefit_system = baseline.tax_benefit_system
+        for needed_column_name in tax_benefit_system.get_dependencies_closure([column_name]).union([column_name]):
+            if needed_column_name in affected_column_names:
+                continue
+            baseline_holder = baseline.get_holder(needed_column_name, None)
+            if baseline_holder is None or baseline_holder.array is None or baseline_holder.kind is None:
+                continue
+            reform_holder = reform.get_or_new_holder(needed_column_name)
+            if reform_holder.array is None:
+                baseline_holder.array.setflags(write = False)
+                reform_holder.array = baseline_holder.array
+                reform_holder.kind = baseline_holder.kind
+        reform_array = reform.calculate(column_name)
+        difference = reform_array - baseline_array if baseline_array.dtype.kind in 'fiu' else None
+        return baseline_array, reform_array, difference
+
+    def get_affected_column_names(self):
+        """Return the names of the columns whose arrays may differ between baseline and reform."""
+        changed_paths = self.changed_paths
+        if not changed_paths:
+            return set()
+        baseline = self.baseline
+        date_dependent_column_names = baseline.get_date_dependent_column_names()
+        if ('datesim',) in changed_paths:
+            return set(date_dependent_column_names)
+        legislation_paths_by_column_name = baseline.legislation_paths_by_column_name
+        column_by_name = baseline.tax_benefit_system.column_by_name
+        affected_column_names = set()
+        for column_name in date_dependent_column_names:
+            legislation_paths = legislation_paths_by_column_name.get(column_name)
+            formula_class = column_by_name[column_name].formula_constructor
+            if legislation_paths is None or formula_class is not None and any(
+                    simple_formula_class.requires_other_dates
+                    for simple_formula_class in formula_class.iter_simple_formula_classes()
+                    ):
+                # Formula not (yet) called by baseline, or using the legislation of other dates: consider it as
+                # affected.
+                affected_column_names.add(column_name)
+                continue
+            for legislation_path in legislation_paths:
+                if any(
+                        changed_path[:len(legislation_path)] == legislation_path
+                            or legislation_path[:len(changed_path)] == changed_path
+                        for changed_path in changed_paths
+                        ):
+                    affected_column_names.add(column_name)
+                    break
+        return affected_column_names.union(baseline.tax_benefit_system.get_consumers_closure(affected_column_names))
+
+
+def solve_parameter(simulation, path, column_name, lower, upper, target = None, max_iterations = 50, tolerance = 1,
+        weight_column_name = None):
+    """Return the value of a legislation parameter for which the (weighted) total of a column reaches a target.
+
+    path is the dotted path of the parameter in the compact legislation (for example "ir.taux"). When target is None,
+    the total of the baseline simulation is used (revenue-neutral reform). lower and upper must bracket the solution.
+    The search uses the Illinois variant of regula falsi and, at each iteration, only the formulas downstream of the
+    parameter are recomputed (see ReformComparison). Returns None when the search doesn't converge.
+    """
+    path = tuple(path.split('.'))
+    baseline_compact_legislation = simulation.compact_legislation
+    if simulation.legislation_paths_by_column_name is None:
+        # Record the legislation paths before calculating baseline, so that iterations share its unaffected arrays.
+        simulation.legislation_paths_by_column_name = {}
+    if weight_column_name is not None:
+        assert simulation.entity_by_column_name[weight_column_name] is simulation.entity_by_column_name[column_name], \
+            u"Columns {} and {} don't belong to the same entity".format(column_name, weight_column_name).encode(
+                'utf-8')
+        weights = simulation.calculate(weight_column_name)
+
+    def get_total(array):
+        return float(np.sum(array if weight_column_name is None else array * weights, dtype = np.float64))
+
+    if target is None:
+        target = get_total(simulation.calculate(column_name))
+
+    def evaluate(value):
+        comparison = ReformComparison(simulation, legislations.patch_compact_node(baseline_compact_legislation, path,
+            value), reform_compact_legislation_getter = lambda date: legislations.patch_compact_node(
+                simulation.get_compact_legislation(date), path, value))
+        return get_total(comparison.calculate(column_name)[1]) - target
+
+    lower_error = evaluate(lower)
+    if abs(lower_error) <= tolerance:
+        return lower
+    upper_error = evaluate(upper)
+    if abs(upper_error) <= tolerance:
+        return upper
+    assert np.sign(lower_error) != np.sign(upper_error), u"Bounds {} and {} don't bracket target {}".format(lower,
+        upper, target).encode('utf-8')
+    for iteration in xrange(max_iterations):
+        value = upper - upper_error * (upper - lower) / (upper_error - lower_error)
+        error = evaluate(value)
+        if abs(error) <= tolerance:
+            return value
+        if np.sign(error) != np.sign(upper_error):
+            lower, lower_error = upper, upper_error
+        else:
+            lower_error /= 2
+        upper, upper_error = value, error
+    return None
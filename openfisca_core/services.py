@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Non-blocking simulation service, for event-driven web servers
+
+Simulations are built and calculated by a bounded pool of threads or processes. Results are given to a callback
+(called from a thread of the pool, so event loops must use their thread-safe hook, like IOLoop.add_callback of
+Tornado) or waited for with Request.get.
+"""
+
+
+import cPickle
+import multiprocessing
+import multiprocessing.pool
+import sys
+import threading
+import time
+
+import numpy as np
+
+from . import shards
+
+
+# Exceptions
+
+
+class ServiceOverloadedError(Exception):
+    def __str__(self):
+        return 'Too many pending requests'
+
+
+# Service
+
+
+def _calculate(new_simulation, column_names):
+    try:
+        return None, shards.calculate_arrays(new_simulation(), column_names)
+    except Exception as exception:
+        return exception, None
+
+
+def _calculate_in_process(new_simulation, column_names):
+    error, result = _calculate(new_simulation, column_names)
+    if error is not None:
+        # When the outcome of a task can't be pickled, the pool doesn't call the callback of the task, so the error must
+        # always be picklable.
+        try:
+            cPickle.dumps(error, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            error = RuntimeError(u'{}: {}'.format(error.__class__.__name__, error).encode('utf-8'))
+    return error, result
+
+
+class Request(object):
+    callback = None
+    error = None
+    event = None
+    lock = None  # Protects the outcome of request, set by either the pool or the timer
+    result = None
+
+    def __init__(self, callback = None):
+        self.callback = callback
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+
+    def done(self, error, result):
+        """Set the outcome of request, unless it is already known (ie request has timed out)."""
+        with self.lock:
+            if self.event.is_set():
+                return
+            self.error = error
+            self.result = result
+            self.event.set()
+        if self.callback is not None:
+            self.callback(self)
+
+    def get(self, timeout = None):
+        """Wait for the arrays calculated by request and return them, or raise its error."""
+        if not self.event.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Service(object):
+    """Bounded pool of workers calculating simulations, with admission control and timeouts"""
+    pending_semaphore = None
+    pool = None
+    processes = False
+    timeout = None  # Default delay (in seconds) after which a request fails
+
+    def __init__(self, max_pending = 100, processes = False, timeout = None, workers_count = None):
+        """Start the pool of workers.
+
+        When processes is True, the workers are forked processes, so functions given to submit must be picklable.
+        """
+        self.pending_semaphore = threading.BoundedSemaphore(max_pending)
+        if processes:
+            self.processes = True
+        self.pool = multiprocessing.Pool(workers_count) if processes \
+            else multiprocessing.pool.ThreadPool(workers_count)
+        if timeout is not None:
+            self.timeout = timeout
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, new_simulation, column_names, callback = None, timeout = None):
+        """Build a simulation (by calling new_simulation) and calculate its columns in a worker, without blocking.
+
+        Raises ServiceOverloadedError when too many requests are pending, or the pickling error when the workers are
+        processes and new_simulation or column_names can't be pickled. The callback receives the request once its
+        arrays are calculated, or once it has failed or timed out.
+        """
+        if not self.pending_semaphore.acquire(False):
+            raise ServiceOverloadedError()
+        request = Request(callback = callback)
+
+        def handle_result(error_and_result):
+            # The worker is free again, even if request has timed out.
+            self.pending_semaphore.release()
+            request.done(*error_and_result)
+
+        try:
+            if self.processes:
+                # A task that can't be pickled would fail in the pool without calling handle_result, so check it first.
+                cPickle.dumps((new_simulation, column_names), cPickle.HIGHEST_PROTOCOL)
+                self.pool.apply_async(_calculate_in_process, (new_simulation, column_names), callback = handle_result)
+            else:
+                self.pool.apply_async(_calculate, (new_simulation, column_names), callback = handle_result)
+        except:
+            self.pending_semaphore.release()
+            raise
+        if timeout is None:
+            timeout = self.timeout
+        if timeout is not None:
+            timer = threading.Timer(timeout, request.done, args = (multiprocessing.TimeoutError(), None))
+            timer.daemon = True
+            timer.start()
+        return request
+
+
+# Load test
+
+
+def load_test(service, new_simulation, column_names, concurrency = 10, requests_count = 1000):
+    """Send requests to a service from concurrent clients and return the percentiles of their latency (in seconds).
+
+    Rejected requests (see ServiceOverloadedError) and failed ones are counted, but not in latencies.
+    """
+    latencies = []
+    errors_count_by_name = {}
+    lock = threading.Lock()
+    remaining_requests = [requests_count]
+
+    def run_client():
+        while True:
+            with lock:
+                if remaining_requests[0] <= 0:
+                    return
+                remaining_requests[0] -= 1
+            start_time = time.time()
+            try:
+                service.submit(new_simulation, column_names).get()
+            except Exception:
+                error_name = sys.exc_info()[0].__name__
+                with lock:
+                    errors_count_by_name[error_name] = errors_count_by_name.get(error_name, 0) + 1
+                continue
+            with lock:
+                latencies.append(time.time() - start_time)
+
+    start_time = time.time()
+    clients = [threading.Thread(target = run_client) for index in range(concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    duration = time.time() - start_time
+    report = dict(
+        duration = duration,
+        errors_count_by_name = errors_count_by_name,
+        requests_per_second = requests_count / duration,
+        )
+    if latencies:
+        report.update(
+            latency_max = max(latencies),
+            latency_p50 = np.percentile(latencies, 50),
+            latency_p90 = np.percentile(latencies, 90),
+            latency_p99 = np.percentile(latencies, 99),
+            )
+    return report
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Run a simulation by shards of households, in a pool of processes or on several (worker) nodes."""
+
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+from . import columns, simulations
+
+
+log = logging.getLogger(__name__)
+
+
+# Globals of worker processes
+worker_simulation = None
+worker_simulation_dir = None
+worker_tax_benefit_system = None
+
+
+def _calculate_shard(households_slice, column_names, entity):
+    global worker_simulation
+    if worker_simulation is None:
+        # Input arrays are memory-mapped, so they are shared by every worker instead of being copied.
+        worker_simulation = simulations.Simulation.load(worker_simulation_dir, worker_tax_benefit_system)
+    return calculate_shard(worker_simulation, households_slice, column_names, entity)
+
+
+def _initialize_worker(tax_benefit_system, simulation_dir):
+    global worker_simulation, worker_simulation_dir, worker_tax_benefit_system
+    worker_simulation = None
+    worker_simulation_dir = simulation_dir
+    worker_tax_benefit_system = tax_benefit_system
+
+
+def _coordinate_worker(address, authkey, column_names, pending_shards, shards_files, array_by_shard_index,
+        failed_shards_index, max_attempts, lock):
+    try:
+        connection = multiprocessing.connection.Client(address, authkey = authkey)
+    except Exception:
+        log.exception(u'Connection to worker {} failed'.format(address))
+        return
+    try:
+        while len(array_by_shard_index) + len(failed_shards_index) < len(shards_files):
+            try:
+                shard_index, attempts = pending_shards.get(timeout = 0.1)
+            except Queue.Empty:
+                continue
+            try:
+                connection.send(('calculate', shards_files[shard_index], column_names))
+                status, value = connection.recv()
+            except Exception:
+                log.exception(u'Worker {} lost while calculating shard {}'.format(address, shard_index))
+                pending_shards.put((shard_index, attempts))
+                return
+            if status == 'ok':
+                with lock:
+                    array_by_shard_index[shard_index] = value
+            elif attempts + 1 < max_attempts:
+                log.error(u'Worker {} failed to calculate shard {}: {}'.format(address, shard_index, value))
+                pending_shards.put((shard_index, attempts + 1))
+            else:
+                log.error(u'Worker {} failed to calculate shard {}: {}'.format(address, shard_index, value))
+                with lock:
+                    failed_shards_index.add(shard_index)
+        connection.send(('close', None, None))
+    except Exception:
+        log.exception(u'Communication with worker {} failed'.format(address))
+    finally:
+        connection.close()
+
+
+def calculate_arrays(simulation, column_names):
+    """Calculate the given columns and return their arrays, with strings decoded."""
+    array_by_column_name = {}
+    for column_name in column_names:
+        holder = simulation.compute(column_name)
+        array = holder.array
+        if isinstance(holder.column, columns.StrCol):
+            # Codes of strings may differ between processes.
+            array = holder.column.decode(array)
+        array_by_column_name[column_name] = array
+    return array_by_column_name
+
+
+def calculate_shard(simulation, households_slice, column_names, entity):
+    """Calculate the given columns for a slice of households and return their arrays."""
+    start, stop = households_slice
+    shard = simulation.select(simulation.get_households_index_by_key_plural(np.arange(start, stop),
+        entity = entity))
+    return calculate_arrays(shard, column_names)
+
+
+def calculate_with_processes(simulation, column_names, entity = None, processes_count = None, shards_count = None):
+    """Calculate columns in a pool of processes, each one handling shards of whole households.
+
+    Inputs arrays are given to the workers through memory-mapped files. Returns the arrays of the requested columns,
+    identical to the ones calculated by a single process.
+
+    Worker processes are forked and inherit the tax-benefit system (POSIX only).
+    """
+    if processes_count is None:
+        processes_count = multiprocessing.cpu_count()
+    if shards_count is None:
+        shards_count = processes_count * 4
+    households_slices = iter_households_slices(simulation, shards_count, entity = entity)
+    simulation_dir = tempfile.mkdtemp(prefix = 'openfisca-')
+    try:
+        simulation.save(simulation_dir, inputs_only = True)
+        pool = multiprocessing.Pool(processes_count, initializer = _initialize_worker,
+            initargs = (simulation.tax_benefit_system, simulation_dir))
+        try:
+            results = [
+                pool.apply_async(_calculate_shard, (households_slice, column_names, entity))
+                for households_slice in households_slices
+                ]
+            return gather_shards_arrays(simulation, column_names, households_slices,
+                (result.get() for result in results), entity = entity)
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        shutil.rmtree(simulation_dir)
+
+
+def calculate_with_workers(simulation, column_names, addresses, authkey, entity = None, max_attempts = 3,
+        shards_count = None):
+    """Calculate columns on worker nodes (see serve_shards), each one handling shards of whole households.
+
+    The input files of each shard (see Simulation.save) are sent to the first available worker. A shard that fails is
+    retried (on any worker) up to max_attempts times. Workers use their own tax-benefit system, which must be the same
+    as the one of the simulation. The legislation of the simulation (for example a reform) is sent with each shard.
+
+    authkey is the secret shared with the workers (see serve_shards).
+    """
+    if not authkey:
+        # Not an assertion: it must not be skipped by "python -O".
+        raise ValueError(u"An authentication key is required to communicate with workers")
+    if shards_count is None:
+        shards_count = len(addresses) * 4
+    households_slices = iter_households_slices(simulation, shards_count, entity = entity)
+    shards_files = []
+    for start, stop in households_slices:
+        shard = simulation.select(simulation.get_households_index_by_key_plural(np.arange(start, stop),
+            entity = entity))
+        shard_dir = tempfile.mkdtemp(prefix = 'openfisca-')
+        try:
+            shard.save(shard_dir, inputs_only = True)
+            shards_files.append(read_files(shard_dir))
+        finally:
+            shutil.rmtree(shard_dir)
+
+    pending_shards = Queue.Queue()
+    for shard_index in range(len(shards_files)):
+        pending_shards.put((shard_index, 0))
+    array_by_shard_index = {}
+    failed_shards_index = set()
+    lock = threading.Lock()
+    threads = [
+        threading.Thread(target = _coordinate_worker, args = (address, authkey, column_names, pending_shards,
+            shards_files, array_by_shard_index, failed_shards_index, max_attempts, lock))
+        for address in addresses
+        ]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    missing_shards_index = set(range(len(shards_files))) - set(array_by_shard_index)
+    if missing_shards_index:
+        raise RuntimeError(u'Calculation of shards {} failed'.format(sorted(missing_shards_index)).encode('utf-8'))
+    return gather_shards_arrays(simulation, column_names, households_slices,
+        (array_by_shard_index[shard_index] for shard_index in range(len(shards_files))), entity = entity)
+
+
+def check_relative_path(path):
+    """Ensure that a file path is relative and has no ".." component, so that it stays inside its directory."""
+    if os.path.isabs(path) or os.pardir in path.split(os.sep):
+        raise ValueError(u"Unsafe file path: {}".format(path).encode('utf-8'))
+    return path
+
+
+def gather_shards_arrays(simulation, column_names, households_slices, shards_arrays, entity = None):
+    """Merge the arrays calculated for each slice of households into arrays of the whole simulation."""
+    array_by_column_name = {}
+    for households_slice, shard_array_by_column_name in zip(households_slices, shards_arrays):
+        start, stop = households_slice
+        index_by_key_plural = simulation.get_households_index_by_key_plural(np.arange(start, stop), entity = entity)
+        for column_name in column_names:
+            column_entity = simulation.entity_by_column_name[column_name]
+            column = column_entity.column_by_name[column_name]
+            shard_array = shard_array_by_column_name[column_name]
+            if isinstance(column, columns.StrCol):
+                shard_array = column.encode(shard_array)
+            array = array_by_column_name.get(column_name)
+            if array is None:
+                array_by_column_name[column_name] = array = np.empty(column_entity.count, dtype = shard_array.dtype)
+            array[index_by_key_plural[column_entity.key_plural]] = shard_array
+    return array_by_column_name
+
+
+def iter_households_slices(simulation, shards_count, entity = None):
+    """Split the households (or any other group entity) into at most shards_count slices of consecutive households."""
+    households_count = simulation.entity_by_key_singular[entity].count
+    bounds = np.linspace(0, households_count, min(shards_count, households_count) + 1).astype(int)
+    return [
+        (start, stop)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+        if stop > start
+        ]
+
+
+def read_files(directory):
+    """Return the content of the files of a directory (and its sub-directories), by relative path."""
+    content_by_path = {}
+    for parent_dir, dirs_name, files_name in os.walk(directory):
+        for file_name in files_name:
+            file_path = os.path.join(parent_dir, file_name)
+            with open(file_path, 'rb') as content_file:
+                content_by_path[check_relative_path(os.path.relpath(file_path, directory))] = content_file.read()
+    return content_by_path
+
+
+def serve_shards(tax_benefit_system, address, authkey):
+    """Run a worker node, calculating the shards sent by calculate_with_workers.
+
+    The tax-benefit system is loaded once and used for every shard. The worker serves one coordinator at a time and
+    runs forever.
+
+    Messages are pickled, so a worker must only accept trusted coordinators: authkey, the secret shared with them, is
+    required.
+    """
+    if not authkey:
+        # Not an assertion: it must not be skipped by "python -O".
+        raise ValueError(u"An authentication key is required to accept coordinators")
+    listener = multiprocessing.connection.Listener(address, authkey = authkey)
+    try:
+        while True:
+            connection = listener.accept()
+            try:
+                while True:
+                    command, shard_files, column_names = connection.recv()
+                    if command == 'close':
+                        break
+                    assert command == 'calculate', command
+                    shard_dir = tempfile.mkdtemp(prefix = 'openfisca-')
+                    try:
+                        write_files(shard_dir, shard_files)
+                        shard = simulations.Simulation.load(shard_dir, tax_benefit_system)
+                        reply = ('ok', calculate_arrays(shard, column_names))
+                    except Exception as exception:
+                        log.exception(u'Calculation of shard failed')
+                        reply = ('error', unicode(exception))
+                    finally:
+                        shutil.rmtree(shard_dir)
+                    connection.send(reply)
+            except EOFError:
+                pass
+            finally:
+                connection.close()
+    finally:
+        listener.close()
+
+
+def write_files(directory, content_by_path):
+    """Write files returned by read_files into a directory.
+
+    Absolute paths and paths going out of the directory are rejected.
+    """
+    for path, content in content_by_path.iteritems():
+        file_path = os.path.join(directory, check_relative_path(path))
+        file_dir = os.path.dirname(file_path)
+        if not os.path.exists(file_dir):
+            os.makedirs(file_dir)
+        with open(file_path, 'wb') as content_file:
+            content_file.write(content)
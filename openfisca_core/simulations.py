@@ -24,64 +24,278 @@
 
 
 import collections
+import cPickle
+import datetime
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from . import columns
 
 
 class Simulation(object):
+    arrays_bytes = 0  # Size of the arrays of all holders
     compact_legislation = None
+    compact_legislation_by_date = None  # Legislations used by the computed arrays kept for other dates (see set_date)
+    compact_legislation_getter = None  # Function returning the compact legislation of a date, for a reform
     date = None
+    date_dependent_column_names = None  # Cache of get_date_dependent_column_names()
+    dated_input_column_names = None  # Names of input columns that have an array by date
     debug = False
     debug_all = False  # When False, log only formula calls with non-default parameters.
     default_compact_legislation = None
     entity_by_column_name = None
     entity_by_key_plural = None
     entity_by_key_singular = None
+    legislation_paths_by_column_name = None  # When not None, formulas record the legislation paths they read here.
+    original_index_by_key_plural = None  # Positions of the members of each entity in the simulation they come from
+    peak_arrays_bytes = 0  # Maximum value reached by arrays_bytes
+    permutation_by_key_plural = None  # Original positions of the members of each entity reordered by sort_persons()
     persons = None
+    random_seed = 0  # Global seed of random streams (see method get_random)
+    requested_formulas_by_date = None  # Formulas being calculated at the dates left by calculate(date = ...)
+    result_cache = None  # Optional caches.ResultCache of computed arrays, checked before running formulas
     steps_count = 1
     tax_benefit_system = None
+    template = None  # SimulationTemplate of the current date, kept alive by the simulation
     trace = False
     traceback = None
 
-    def __init__(self, compact_legislation = None, date = None, debug = False, debug_all = False,
-            tax_benefit_system = None, trace = False):
+    def __init__(self, compact_legislation = None, compact_legislation_getter = None, date = None, debug = False,
+            debug_all = False, random_seed = None, record_legislation_paths = False, tax_benefit_system = None,
+            trace = False):
         assert date is not None
         self.date = date
+        if compact_legislation_getter is not None:
+            # Needed by a simulation using a specific compact legislation to calculate arrays at other dates.
+            self.compact_legislation_getter = compact_legislation_getter
+            if compact_legislation is None:
+                compact_legislation = compact_legislation_getter(date)
         if debug:
             self.debug = True
         if debug_all:
             assert debug
             self.debug_all = True
+        if record_legislation_paths:
+            # Needed by reforms.ReformComparison to share the arrays that a reform doesn't change.
+            self.legislation_paths_by_column_name = {}
+        if random_seed is not None:
+            self.random_seed = random_seed
         assert tax_benefit_system is not None
         self.tax_benefit_system = tax_benefit_system
         if trace:
             self.trace = True
             self.traceback = collections.OrderedDict()
 
+        # Use the static data precomputed for every simulation of the same tax-benefit system and date.
+        self.template = template = tax_benefit_system.get_simulation_template(date)
         self.compact_legislation = compact_legislation \
             if compact_legislation is not None \
-            else tax_benefit_system.get_compact_legislation(date)
-        self.default_compact_legislation = tax_benefit_system.get_compact_legislation(date)
+            else template.compact_legislation
+        self.default_compact_legislation = template.compact_legislation
 
-        self.entity_by_key_plural = dict(
+        self.entity_by_key_plural = entity_by_key_plural = dict(
             (key_plural, entity_class(simulation = self))
-            for key_plural, entity_class in tax_benefit_system.entity_class_by_key_plural.iteritems()
-            )
-        self.entity_by_column_name = dict(
-            (column_name, entity)
-            for entity in self.entity_by_key_plural.itervalues()
-            for column_name in entity.column_by_name.iterkeys()
+            for key_plural, entity_class in template.entity_class_by_key_plural.iteritems()
             )
+        self.entity_by_column_name = entity_by_column_name = {}
+        for key_plural, column_names in template.column_names_by_entity_key_plural.iteritems():
+            entity_by_column_name.update(dict.fromkeys(column_names, entity_by_key_plural[key_plural]))
         self.entity_by_key_singular = dict(
-            (entity.key_singular, entity)
-            for entity in self.entity_by_key_plural.itervalues()
+            (key_singular, entity_by_key_plural[key_plural])
+            for key_singular, key_plural in template.entity_key_plural_by_key_singular.iteritems()
             )
+        if template.persons_key_plural is not None:
+            self.persons = entity_by_key_plural[template.persons_key_plural]
+
+    def _change_members(self, entity, count, transform):
+        """Transform the input arrays of an entity whose members change, and forget its computed arrays.
+
+        Returns the names of the columns whose computed arrays are forgotten.
+        """
+        assert self.steps_count == 1
+        forgotten_column_names = set()
+        for column_name, holder in entity.holder_by_name.iteritems():
+            holder.delete_arrays_by_date(computed_only = True)
+            array_by_date = holder.array_by_date
+            if array_by_date:
+                for date, (array, kind) in array_by_date.items():
+                    new_array = transform(array, holder.column)
+                    self.arrays_bytes += new_array.nbytes - array.nbytes
+                    array_by_date[date] = (new_array, kind)
+            if holder.array is None:
+                continue
+            if holder.kind is None:
+                holder.array = transform(holder.array, holder.column)
+            else:
+                del holder.array
+                forgotten_column_names.add(column_name)
+        entity.count = entity.step_size = count
+        return forgotten_column_names
+
+    def _extend_original_index(self, entity, added_count):
+        original_index = (self.original_index_by_key_plural or {}).get(entity.key_plural)
+        if original_index is not None:
+            # New members get new original positions.
+            start = int(original_index.max()) + 1 if original_index.size else 0
+            self._set_original_index(entity, np.concatenate((original_index,
+                np.arange(start, start + added_count, dtype = original_index.dtype))))
+
+    def _extend_groups(self):
+        """Add to group entities the new groups referenced by persons and return the forgotten computed columns."""
+        forgotten_column_names = set()
+        persons = self.persons
         for entity in self.entity_by_key_plural.itervalues():
             if entity.is_persons_entity:
-                self.persons = entity
-                break
+                continue
+            index_holder = persons.holder_by_name.get('id' + entity.symbol)
+            if index_holder is None or index_holder.array is None or index_holder.array.size == 0:
+                continue
+            added_count = int(index_holder.array.max()) + 1 - entity.count
+            if added_count > 0:
+                self._extend_original_index(entity, added_count)
+                forgotten_column_names.update(self._change_members(entity, entity.count + added_count,
+                    lambda array, column: np.concatenate((array, np.array([column.default] * added_count,
+                        dtype = array.dtype)))))
+        return forgotten_column_names
+
+    def _invalidate_memberships(self, column_names):
+        """Invalidate the given columns, the formulas that may use the memberships of persons, and their consumers."""
+        tax_benefit_system = self.tax_benefit_system
+        column_names = set(column_names)
+        column_names.update(
+            column.name
+            for column in tax_benefit_system.column_by_name.itervalues()
+            if column.formula_constructor is not None and any(
+                simple_formula_class.requires_self
+                for simple_formula_class in column.formula_constructor.iter_simple_formula_classes()
+                )
+            )
+        self.invalidate(column_names.union(tax_benefit_system.get_consumers_closure(column_names)))
+
+    def _permute_entity(self, entity, permutation):
+        self._set_original_index(entity, self.get_original_index(entity.key_singular)[permutation])
+        for holder in entity.holder_by_name.itervalues():
+            if holder.array is not None:
+                kind = holder.kind
+                holder.array = holder.array[permutation]
+                holder.kind = kind
+            array_by_date = holder.array_by_date
+            if array_by_date:
+                for date, (array, kind) in array_by_date.items():
+                    array_by_date[date] = (array[permutation], kind)
+
+    def _set_original_index(self, entity, original_index):
+        # Dictionary may be shared with forks.
+        original_index_by_key_plural = dict(self.original_index_by_key_plural or {})
+        original_index_by_key_plural[entity.key_plural] = original_index
+        self.original_index_by_key_plural = original_index_by_key_plural
+
+    def add_persons(self, array_by_column_name):
+        """Add persons (births, immigrants...) to a (dynamic) simulation, without rebuilding it.
 
-    def calculate(self, column_name, lazy = False, requested_formulas = None):
+        array_by_column_name gives the arrays of the new persons for some input columns of persons (at least their "id*"
+        and "qui*" columns). The other columns get their default value. Positions in group entities beyond their count
+        create new groups. The computed arrays of persons and the formulas using memberships are invalidated.
+        """
+        persons = self.persons
+        added_count = None
+        for column_name, array in array_by_column_name.iteritems():
+            holder = self.get_or_new_holder(column_name)
+            assert holder.entity is persons, u"Column {} doesn't belong to persons".format(column_name).encode('utf-8')
+            if added_count is None:
+                added_count = array.size
+            assert array.size == added_count, u"Expected an array of size {} for column {}. Got: {}".format(
+                added_count, column_name, array.size).encode('utf-8')
+            if holder.array is None:
+                holder.array = np.array([holder.column.default] * persons.count, dtype = holder.column.dtype)
+                holder.kind = None
+
+        def extend(array, column):
+            added_array = array_by_column_name.get(column.name)
+            if added_array is None:
+                added_array = np.array([column.default] * added_count, dtype = array.dtype)
+            elif isinstance(column, columns.StrCol):
+                added_array = column.encode(added_array)
+            return np.concatenate((array, added_array.astype(array.dtype)))
+
+        if not added_count:
+            return
+        self._extend_original_index(persons, added_count)
+        forgotten_column_names = self._change_members(persons, persons.count + added_count, extend)
+        forgotten_column_names.update(self._extend_groups())
+        self._invalidate_memberships(forgotten_column_names)
+
+    def calculate(self, column_name, lazy = False, requested_formulas = None, date = None):
+        if date is not None and date != self.date:
+            # Calculate array at another date (aka period), then come back to current date.
+            # Requested formulas are tracked by date, so that a formula may use its own value at another date, while
+            # infinite loops (across dates) are still detected.
+            current_date = self.date
+            requested_formulas_by_date = self.requested_formulas_by_date
+            if requested_formulas_by_date is None:
+                self.requested_formulas_by_date = requested_formulas_by_date = {}
+            outer_requested_formulas = requested_formulas_by_date.get(current_date)
+            requested_formulas_by_date[current_date] = requested_formulas if requested_formulas is not None \
+                else set()
+            self.set_date(date)
+            try:
+                return self.compute(column_name, lazy = lazy,
+                    requested_formulas = requested_formulas_by_date.get(date)).array
+            finally:
+                self.set_date(current_date)
+                if outer_requested_formulas is None:
+                    del requested_formulas_by_date[current_date]
+                else:
+                    requested_formulas_by_date[current_date] = outer_requested_formulas
         return self.compute(column_name, lazy = lazy, requested_formulas = requested_formulas).array
 
+    def calculate_by_chunks(self, column_names, chunk_size = None, entity = None):
+        """Calculate columns by chunks of (at most) chunk_size whole households (or any other group entity).
+
+        Yields, for each chunk, the positions of its members by entity (see get_households_index_by_key_plural) and
+        the arrays of the requested columns, so that memory use is bounded by the size of a chunk and results can be
+        processed before the end of the run.
+        """
+        assert chunk_size > 0
+        households_count = self.entity_by_key_singular[entity].count
+        households_members = self.get_households_members(entity)
+        for start in xrange(0, households_count, chunk_size):
+            index_by_key_plural = self.get_households_index_by_key_plural(
+                np.arange(start, min(start + chunk_size, households_count)), entity = entity,
+                households_members = households_members)
+            chunk = self.select(index_by_key_plural)
+            yield index_by_key_plural, dict(
+                (column_name, chunk.calculate(column_name))
+                for column_name in column_names
+                )
+
+    def calculate_marginal_rates(self, column_name, deltas, column_names):
+        """Return the marginal rates of columns with respect to an input column.
+
+        For each delta, the input column is increased by delta in a fork of this simulation, where only its (transitive)
+        consumers are recomputed. Returns, for each requested column, an array of shape (deltas count, entity count)
+        containing (perturbed array - array) / delta. Deltas must be large compared to the precision of the input
+        column dtype (for example float32).
+        """
+        input_array = self.calculate(column_name)
+        array_by_column_name = dict(
+            (name, self.calculate(name))
+            for name in column_names
+            )
+        rates_by_column_name = dict(
+            (name, np.empty((len(deltas), array.size)))
+            for name, array in array_by_column_name.iteritems()
+            )
+        for delta_index, delta in enumerate(deltas):
+            perturbed = self.fork()
+            perturbed.set_input(column_name, input_array + delta)
+            for name, array in array_by_column_name.iteritems():
+                rates_by_column_name[name][delta_index] = (perturbed.calculate(name) - array) / float(delta)
+        return rates_by_column_name
+
     def compute(self, column_name, lazy = False, requested_formulas = None):
         return self.entity_by_column_name[column_name].compute(
             column_name,
@@ -89,15 +303,745 @@ class Simulation(object):
             requested_formulas = requested_formulas,
             )
 
+    def extract(self, households_index, entity = None):
+        """Return a standalone simulation containing only the given households (or any other group entity).
+
+        Both input and computed arrays are extracted, so that the results of the households are available without any
+        recomputation.
+        """
+        return self.select(self.get_households_index_by_key_plural(np.atleast_1d(households_index), entity = entity),
+            inputs_only = False)
+
+    def fork(self, compact_legislation = None, compact_legislation_getter = None):
+        """Return a new simulation sharing the arrays of this simulation.
+
+        Shared arrays are made read-only and are copied only when one of the simulations asks to modify them (see
+        Holder.get_writable_array). When a different compact legislation is given (for a reform), only the input arrays
+        are shared; the other ones are recomputed by the new simulation. compact_legislation_getter gives the reform
+        legislation of the other dates (see set_date).
+        """
+        if compact_legislation is None:
+            compact_legislation = self.compact_legislation
+        if compact_legislation_getter is None and compact_legislation is self.compact_legislation:
+            compact_legislation_getter = self.compact_legislation_getter
+        new = self.__class__(
+            compact_legislation = compact_legislation,
+            compact_legislation_getter = compact_legislation_getter,
+            date = self.date,
+            debug = self.debug,
+            debug_all = self.debug_all,
+            random_seed = self.random_seed,
+            record_legislation_paths = self.legislation_paths_by_column_name is not None,
+            tax_benefit_system = self.tax_benefit_system,
+            trace = self.trace,
+            )
+        if self.legislation_paths_by_column_name is not None and compact_legislation is self.compact_legislation:
+            new.legislation_paths_by_column_name = dict(
+                (column_name, legislation_paths.copy())
+                for column_name, legislation_paths in self.legislation_paths_by_column_name.iteritems()
+                )
+        new.original_index_by_key_plural = self.original_index_by_key_plural
+        new.permutation_by_key_plural = self.permutation_by_key_plural
+        new.result_cache = self.result_cache
+        new.steps_count = self.steps_count
+        if self.dated_input_column_names is not None:
+            new.dated_input_column_names = self.dated_input_column_names.copy()
+        if self.compact_legislation_by_date is not None and compact_legislation is self.compact_legislation:
+            new.compact_legislation_by_date = self.compact_legislation_by_date.copy()
+        new.entity_by_key_plural = entity_by_key_plural = dict(
+            (key_plural, entity.copy_for_simulation(new))
+            for key_plural, entity in self.entity_by_key_plural.iteritems()
+            )
+        new.entity_by_column_name = dict(
+            (column_name, entity_by_key_plural[entity.key_plural])
+            for column_name, entity in self.entity_by_column_name.iteritems()
+            )
+        new.entity_by_key_singular = dict(
+            (key_singular, entity_by_key_plural[entity.key_plural])
+            for key_singular, entity in self.entity_by_key_singular.iteritems()
+            )
+        new.persons = entity_by_key_plural[self.persons.key_plural]
+
+        # Formulas are created once every holder has been copied, because they link to the holders of their
+        # parameters.
+        for entity in entity_by_key_plural.itervalues():
+            for holder in entity.holder_by_name.values():
+                if compact_legislation is not self.compact_legislation:
+                    holder.delete_arrays_by_date(computed_only = True)
+                    if holder.kind is not None:
+                        del holder.array
+                column = holder.column
+                if holder.formula is None and column.formula_constructor is not None:
+                    holder.formula = column.formula_constructor(holder = holder)
+        return new
+
+    def get_compact_legislation(self, date):
+        """Return the compact legislation used by the simulation at a date."""
+        if date == self.date:
+            return self.compact_legislation
+        compact_legislation_getter = self.compact_legislation_getter
+        if compact_legislation_getter is None:
+            assert self.compact_legislation is self.default_compact_legislation, \
+                'A simulation using a specific compact legislation needs a compact_legislation_getter to give the ' \
+                'legislation of other dates'
+            return self.tax_benefit_system.get_simulation_template(date).compact_legislation
+        # Reuse the legislation of the computed arrays kept for this date, so that they remain valid.
+        compact_legislation = (self.compact_legislation_by_date or {}).get(date)
+        return compact_legislation if compact_legislation is not None else compact_legislation_getter(date)
+
+    def get_date_dependent_column_names(self):
+        date_dependent_column_names = self.date_dependent_column_names
+        if date_dependent_column_names is None:
+            tax_benefit_system = self.tax_benefit_system
+            date_dependent_column_names = tax_benefit_system.get_date_dependent_column_names()
+            dated_input_column_names = self.dated_input_column_names
+            if dated_input_column_names:
+                date_dependent_column_names = date_dependent_column_names.union(dated_input_column_names,
+                    tax_benefit_system.get_consumers_closure(dated_input_column_names))
+            self.date_dependent_column_names = date_dependent_column_names
+        return date_dependent_column_names
+
     def get_holder(self, column_name, default = UnboundLocalError):
         entity = self.entity_by_column_name[column_name]
         if default is UnboundLocalError:
             return entity.holder_by_name[column_name]
         return entity.holder_by_name.get(column_name, default)
 
+    def get_households_index_by_key_plural(self, households_index, entity = None, households_members = None):
+        """Return the positions of the members of the given households (or any other group entity), by entity.
+
+        The other group entities must be contained in the given households. When this method is called for many subsets
+        of households, give it the result of get_households_members (and distinct households), to avoid passes over
+        the whole population.
+        """
+        assert entity is not None
+        household_entity = self.entity_by_key_singular[entity]
+        assert not household_entity.is_persons_entity
+        persons = self.persons
+        if households_members is None:
+            selected_households = np.zeros(household_entity.count, dtype = np.bool)
+            selected_households[households_index] = True
+            persons_index = np.nonzero(
+                selected_households[persons.holder_by_name['id' + household_entity.symbol].array])[0]
+            members_count_by_key_plural = None
+        else:
+            persons_order, households_offsets, members_count_by_key_plural = households_members
+            starts = households_offsets[households_index]
+            counts = households_offsets[np.asarray(households_index) + 1] - starts
+            positions = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+            persons_index = np.sort(persons_order[positions])
+        index_by_key_plural = {}
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            if entity.is_persons_entity:
+                index_by_key_plural[key_plural] = persons_index
+                continue
+            entity_index_holder = persons.holder_by_name.get('id' + entity.symbol)
+            if entity_index_holder is None:
+                index_by_key_plural[key_plural] = np.arange(0)
+                continue
+            entity_index_array = entity_index_holder.array
+            index, selected_members_count = np.unique(entity_index_array[persons_index], return_counts = True)
+            members_count = np.bincount(entity_index_array, minlength = entity.count) \
+                if members_count_by_key_plural is None else members_count_by_key_plural[key_plural]
+            assert (members_count[index] == selected_members_count).all(), \
+                u'Some {} are not contained in the selected {}'.format(key_plural, household_entity.key_plural) \
+                    .encode('utf-8')
+            index_by_key_plural[key_plural] = index
+        return index_by_key_plural
+
+    def get_households_members(self, entity):
+        """Return the persons sorted by household (or any other group entity), the position of the first member of each
+        household in them and the members count of each group entity (see get_households_index_by_key_plural).
+        """
+        household_entity = self.entity_by_key_singular[entity]
+        persons = self.persons
+        households_index_array = persons.holder_by_name['id' + household_entity.symbol].array
+        # Stable sort keeps the members of each household in their order.
+        persons_order = np.argsort(households_index_array, kind = 'mergesort')
+        households_offsets = np.concatenate(([0], np.cumsum(np.bincount(households_index_array,
+            minlength = household_entity.count))))
+        members_count_by_key_plural = dict(
+            (key_plural, np.bincount(persons.holder_by_name['id' + entity.symbol].array, minlength = entity.count))
+            for key_plural, entity in self.entity_by_key_plural.iteritems()
+            if not entity.is_persons_entity and 'id' + entity.symbol in persons.holder_by_name
+            )
+        return persons_order, households_offsets, members_count_by_key_plural
+
+    def get_original_index(self, entity):
+        """Return the positions of the members of an entity in the simulation they come from (see method select)."""
+        entity = self.entity_by_key_singular[entity]
+        original_index = (self.original_index_by_key_plural or {}).get(entity.key_plural)
+        if original_index is None:
+            original_index = np.arange(entity.count)
+        return original_index
+
+    def get_random(self, column_name, entity = None, draw = 0):
+        """Return uniform random numbers in [0, 1) for the members of an entity (default: persons).
+
+        Numbers come from counter-based streams keyed by random_seed, column name, draw and original position of each
+        member (see method get_original_index). So they don't depend on the order of calculations, and chunked or
+        parallel runs give the same numbers as serial ones. Use another draw to get other independent numbers.
+        """
+        entity = self.persons if entity is None else self.entity_by_key_singular[entity]
+        key = np.uint64(int(hashlib.sha1(u'{}:{}:{}:{}'.format(self.random_seed, column_name, entity.key_plural,
+            draw).encode('utf-8')).hexdigest()[:16], 16))
+        counters = self.get_original_index(entity.key_singular).astype(np.uint64)
+        values = _mix64(_mix64(counters * np.uint64(0x9e3779b97f4a7c15) + key))
+        return (values >> np.uint64(11)).astype(np.float64) / float(1 << 53)
+
     def get_or_new_holder(self, column_name):
         entity = self.entity_by_column_name[column_name]
         return entity.get_or_new_holder(column_name)
 
     def graph(self, column_name, edges, nodes, visited):
         self.entity_by_column_name[column_name].graph(column_name, edges, nodes, visited)
+
+    def invalidate(self, column_names):
+        """Forget the computed (or default) arrays of the given columns, so that the next calculate recomputes them.
+
+        The computed arrays kept for other dates (see set_date) are forgotten too.
+        """
+        for column_name in column_names:
+            holder = self.get_holder(column_name, None)
+            if holder is None:
+                continue
+            if holder.kind is not None and holder.array is not None:
+                del holder.array
+            holder.delete_arrays_by_date(computed_only = True)
+
+    @classmethod
+    def load(cls, path, tax_benefit_system = None, sort_persons_by = None, **kwargs):
+        """Load a simulation saved by method save.
+
+        Arrays are memory-mapped (and read-only), so loading is nearly instant and only the arrays that are used are
+        read from disk. When sort_persons_by is given, persons are then reordered (see method sort_persons).
+        """
+        with open(os.path.join(path, 'simulation.json')) as simulation_file:
+            simulation_json = json.load(simulation_file)
+        kwargs.setdefault('random_seed', simulation_json.get('random_seed'))
+        if simulation_json.get('compact_legislation') and kwargs.get('compact_legislation') is None:
+            with open(os.path.join(path, 'compact_legislation.pickle'), 'rb') as legislation_file:
+                kwargs['compact_legislation'] = cPickle.load(legislation_file)
+        simulation = cls(
+            date = datetime.date(*(int(fragment) for fragment in simulation_json['date'].split('-'))),
+            tax_benefit_system = tax_benefit_system,
+            **kwargs)
+        simulation.steps_count = simulation_json['steps_count']
+        for key_plural, entity_json in simulation_json['entities'].iteritems():
+            entity = simulation.entity_by_key_plural[key_plural]
+            entity.count = entity_json['count']
+            entity.roles_count = entity_json.get('roles_count')
+            entity.step_size = entity_json['step_size']
+            if entity_json.get('original_index'):
+                simulation._set_original_index(entity, np.load(os.path.join(path, key_plural, '@original_index.npy'),
+                    mmap_mode = 'r'))
+            for column_name, array_json in entity_json['arrays'].iteritems():
+                array_path = os.path.join(path, key_plural, column_name + '.npy')
+                if array_json['dtype'] == u'object':
+                    # Arrays of Python objects are pickled and can't be memory-mapped.
+                    array = np.load(array_path, allow_pickle = True)
+                else:
+                    array = np.load(array_path, mmap_mode = 'r')
+                holder = entity.get_or_new_holder(column_name)
+                categories = array_json.get('categories')
+                if categories is not None:
+                    # Codes of strings may differ between processes.
+                    array = holder.column.encode(categories)[array]
+                holder.array = array
+                holder.kind = array_json.get('kind')
+        if sort_persons_by is not None:
+            simulation.sort_persons(sort_persons_by)
+        return simulation
+
+    def memory_report(self):
+        """Return the number of bytes used by holders arrays, by holder, entity, dtype and kind of array."""
+        bytes_by_dtype = collections.defaultdict(int)
+        bytes_by_entity = collections.defaultdict(int)
+        bytes_by_holder = {}
+        bytes_by_kind = collections.defaultdict(int)
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            bytes_by_entity[key_plural] = 0
+            for column_name, holder in entity.holder_by_name.iteritems():
+                arrays_and_kinds = [(holder.array, holder.kind)]
+                if holder.array_by_date:
+                    arrays_and_kinds.extend(holder.array_by_date.itervalues())
+                for array, kind in arrays_and_kinds:
+                    if array is None:
+                        continue
+                    array_bytes = array.nbytes
+                    bytes_by_dtype[unicode(array.dtype)] += array_bytes
+                    bytes_by_entity[key_plural] += array_bytes
+                    bytes_by_holder[column_name] = bytes_by_holder.get(column_name, 0) + array_bytes
+                    bytes_by_kind[kind or u'input'] += array_bytes
+        return collections.OrderedDict((
+            ('bytes', self.arrays_bytes),
+            ('bytes_by_dtype', dict(bytes_by_dtype)),
+            ('bytes_by_entity', dict(bytes_by_entity)),
+            ('bytes_by_holder', bytes_by_holder),
+            ('bytes_by_kind', dict(bytes_by_kind)),
+            ('peak_bytes', self.peak_arrays_bytes),
+            ))
+
+    def move_persons(self, entity, persons_index, groups_index, roles):
+        """Move persons to other households (or any other group entity), giving them new roles.
+
+        Positions of groups beyond the count of the entity create new groups. The formulas using memberships of persons
+        are invalidated.
+        """
+        group_entity = self.entity_by_key_singular[entity]
+        persons = self.persons
+        for prefix, values in (('id', groups_index), ('qui', roles)):
+            holder = persons.holder_by_name[prefix + group_entity.symbol]
+            array = holder.get_writable_array()
+            array[persons_index] = values
+            # Array has been modified in place.
+            holder.version += 1
+        self._invalidate_memberships(self._extend_groups())
+
+    def remove_persons(self, persons_filter):
+        """Remove persons (deaths, emigrants...) from a (dynamic) simulation, without rebuilding it.
+
+        Group entities keep their positions, even when they become empty. The formulas using memberships of persons
+        are invalidated.
+        """
+        kept_persons = ~np.asarray(persons_filter, dtype = np.bool)
+        persons = self.persons
+        self._set_original_index(persons, self.get_original_index(persons.key_singular)[kept_persons])
+        self._invalidate_memberships(self._change_members(persons, int(kept_persons.sum()),
+            lambda array, column: array[kept_persons]))
+
+    def replicate(self, steps_count):
+        """Return a new simulation made of steps_count copies of the input arrays of this simulation.
+
+        The "id*" columns of persons are offset, so that each copy (aka step) has its own group entities.
+        """
+        assert self.steps_count == 1
+        new = self.__class__(
+            compact_legislation = self.compact_legislation,
+            compact_legislation_getter = self.compact_legislation_getter,
+            date = self.date,
+            debug = self.debug,
+            debug_all = self.debug_all,
+            random_seed = self.random_seed,
+            tax_benefit_system = self.tax_benefit_system,
+            trace = self.trace,
+            )
+        new.steps_count = steps_count
+        # Steps share the random streams of the original members.
+        new.original_index_by_key_plural = dict(
+            (key_plural, np.tile(self.get_original_index(entity.key_singular), steps_count))
+            for key_plural, entity in self.entity_by_key_plural.iteritems()
+            )
+        persons_count = self.persons.count
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            new_entity = new.entity_by_key_plural[key_plural]
+            new_entity.count = entity.count * steps_count
+            new_entity.roles_count = entity.roles_count
+            new_entity.step_size = entity.count
+            for column_name, holder in entity.holder_by_name.iteritems():
+                array = holder.array
+                if array is None or holder.kind is not None:
+                    continue
+                new_entity.get_or_new_holder(column_name).array = np.tile(array, steps_count)
+        for entity in self.entity_by_key_plural.itervalues():
+            if entity.is_persons_entity:
+                continue
+            entity_index_holder = new.persons.holder_by_name.get('id' + entity.symbol)
+            if entity_index_holder is not None:
+                entity_index_holder.array = entity_index_holder.array + np.repeat(
+                    np.arange(steps_count, dtype = entity_index_holder.column.dtype) * entity.count, persons_count)
+        return new
+
+    def restore_order(self, array, entity = None):
+        """Return an array of an entity (default: persons) in the order that preceded sort_persons()."""
+        key_plural = self.persons.key_plural if entity is None else self.entity_by_key_singular[entity].key_plural
+        permutation_by_key_plural = self.permutation_by_key_plural
+        permutation = permutation_by_key_plural.get(key_plural) if permutation_by_key_plural is not None else None
+        if permutation is None:
+            return array
+        original_array = np.empty_like(array)
+        original_array[permutation] = array
+        return original_array
+
+    def save(self, path, inputs_only = False):
+        """Save the arrays (at current date) of every holder into a directory, using one .npy file per column.
+
+        The compact legislation is saved too, when it isn't the default one (for example in a reform).
+        """
+        entities_json = {}
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            entity_dir = os.path.join(path, key_plural)
+            if not os.path.exists(entity_dir):
+                os.makedirs(entity_dir)
+            arrays_json = {}
+            for column_name, holder in entity.holder_by_name.iteritems():
+                array = holder.array
+                if array is None or inputs_only and holder.kind is not None:
+                    continue
+                np.save(os.path.join(entity_dir, column_name + '.npy'), array)
+                arrays_json[column_name] = array_json = dict(
+                    dtype = unicode(array.dtype),
+                    kind = holder.kind,
+                    )
+                if isinstance(holder.column, columns.StrCol):
+                    array_json['categories'] = holder.column.categories
+            entities_json[key_plural] = entity_json = dict(
+                arrays = arrays_json,
+                count = entity.count,
+                roles_count = entity.roles_count,
+                step_size = entity.step_size,
+                )
+            original_index = (self.original_index_by_key_plural or {}).get(key_plural)
+            if original_index is not None:
+                # "@" can't start a column name.
+                np.save(os.path.join(entity_dir, '@original_index.npy'), original_index)
+                entity_json['original_index'] = True
+        has_compact_legislation = self.compact_legislation is not self.default_compact_legislation
+        if has_compact_legislation:
+            with open(os.path.join(path, 'compact_legislation.pickle'), 'wb') as legislation_file:
+                cPickle.dump(self.compact_legislation, legislation_file, cPickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(path, 'simulation.json'), 'w') as simulation_file:
+            json.dump(
+                dict(
+                    compact_legislation = has_compact_legislation,
+                    date = self.date.isoformat(),
+                    entities = entities_json,
+                    random_seed = self.random_seed,
+                    steps_count = self.steps_count,
+                    ),
+                simulation_file,
+                indent = 2,
+                )
+
+    def select(self, index_by_key_plural, inputs_only = True):
+        """Return a new simulation containing only the given persons and group entities.
+
+        index_by_key_plural gives the sorted positions of the kept members of each entity (see
+        get_households_index_by_key_plural). The "id*" columns of persons are re-based to the new positions of the group
+        entities. Only the input arrays (at current date) are copied, unless inputs_only is False.
+        """
+        new = self.__class__(
+            compact_legislation = self.compact_legislation,
+            compact_legislation_getter = self.compact_legislation_getter,
+            date = self.date,
+            debug = self.debug,
+            debug_all = self.debug_all,
+            random_seed = self.random_seed,
+            tax_benefit_system = self.tax_benefit_system,
+            trace = self.trace,
+            )
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            index = index_by_key_plural[key_plural]
+            new_entity = new.entity_by_key_plural[key_plural]
+            new_entity.count = new_entity.step_size = len(index)
+            new_entity.roles_count = entity.roles_count
+            for column_name, holder in entity.holder_by_name.iteritems():
+                array = holder.array
+                if array is None or inputs_only and holder.kind is not None:
+                    continue
+                new_holder = new_entity.get_or_new_holder(column_name)
+                new_holder.array = array[index]
+                new_holder.kind = holder.kind
+        for key_plural, entity in self.entity_by_key_plural.iteritems():
+            if entity.is_persons_entity:
+                continue
+            entity_index_holder = new.persons.holder_by_name.get('id' + entity.symbol)
+            if entity_index_holder is not None:
+                entity_index_holder.array = np.searchsorted(index_by_key_plural[key_plural],
+                    entity_index_holder.array).astype(entity_index_holder.column.dtype)
+        # Without original positions, the positions of the members are their own (see get_original_index).
+        original_index_by_key_plural = self.original_index_by_key_plural or {}
+        new.original_index_by_key_plural = dict(
+            (key_plural, index if key_plural not in original_index_by_key_plural
+                else original_index_by_key_plural[key_plural][index])
+            for key_plural, index in index_by_key_plural.iteritems()
+            )
+        return new
+
+    def set_date(self, date, compact_legislation = None, keep_computed_arrays = True):
+        """Move the simulation to another date (aka period).
+
+        Only the date-dependent holders (ie holders whose formulas, or the formulas they depend on, read the
+        legislation or select a dated formula) get new arrays. The arrays of the other holders are computed once and
+        shared by every date.
+
+        The computed arrays of the date-dependent holders are kept by date, unless keep_computed_arrays is False.
+        A simulation using a specific compact legislation (for a reform) needs the one of the new date, given either
+        explicitly or by its compact_legislation_getter. The computed arrays kept for the new date are used only when
+        they were calculated with the same legislation.
+        """
+        if date == self.date and compact_legislation is None:
+            return
+        template = self.tax_benefit_system.get_simulation_template(date)
+        if compact_legislation is None:
+            compact_legislation = self.get_compact_legislation(date)
+        compact_legislation_by_date = self.compact_legislation_by_date
+        if compact_legislation_by_date is None:
+            self.compact_legislation_by_date = compact_legislation_by_date = {}
+        if date == self.date:
+            legislation_changed = compact_legislation is not self.compact_legislation
+        else:
+            compact_legislation_by_date[self.date] = self.compact_legislation
+            legislation_changed = compact_legislation_by_date.pop(date, compact_legislation) \
+                is not compact_legislation
+        date_dependent_column_names = self.get_date_dependent_column_names()
+        for entity in self.entity_by_key_plural.itervalues():
+            for column_name, holder in entity.holder_by_name.iteritems():
+                if column_name in date_dependent_column_names:
+                    if date != self.date:
+                        holder.set_date(date)
+                    if legislation_changed and holder.kind is not None and holder.array is not None:
+                        # Computed array doesn't match the new legislation.
+                        del holder.array
+                    if not keep_computed_arrays:
+                        holder.delete_arrays_by_date(computed_only = True)
+        self.date = date
+        self.template = template
+        self.default_compact_legislation = template.compact_legislation
+        self.compact_legislation = compact_legislation
+
+    def set_input(self, column_name, array, date = None):
+        """Replace the array of a column and invalidate only the computed holders that depend on it.
+
+        When a date is given, the column gets a different array for each date.
+        """
+        if date is not None:
+            dated_input_column_names = self.dated_input_column_names
+            if dated_input_column_names is None:
+                self.dated_input_column_names = dated_input_column_names = set()
+            if column_name not in dated_input_column_names:
+                dated_input_column_names.add(column_name)
+                self.date_dependent_column_names = None
+            if date != self.date:
+                current_date = self.date
+                self.set_date(date)
+                try:
+                    self.set_input(column_name, array)
+                finally:
+                    self.set_date(current_date)
+                return
+        holder = self.get_or_new_holder(column_name)
+        column = holder.column
+        entity = holder.entity
+        assert isinstance(array, np.ndarray), u"Expected a Numpy array. Got: {}".format(array).encode('utf-8')
+        assert array.size == entity.count, u"Expected an array of size {}. Got: {}".format(entity.count, array.size)
+        if array.dtype != column.dtype:
+            array = column.encode(array) if isinstance(column, columns.StrCol) else array.astype(column.dtype)
+        holder.array = array
+        holder.kind = None
+        self.invalidate(self.tax_benefit_system.get_consumers_closure([column_name]))
+
+    def solve_input(self, column_name, target_column_name, targets, lower, upper, entity = None, max_iterations = 50,
+            tolerance = 0.01):
+        """Return the values of an input column giving the target values of a computed column.
+
+        Uses a vectorised bracketed search, alternating secant and bisection steps. Both columns must belong to the same
+        entity and each row is solved independently, assuming that its computed value depends only on its own input
+        value. lower and upper (scalars or arrays) must bracket the solution: rows that are not bracketed or that don't
+        converge are NaN. At each iteration, only the consumers of the input column are recomputed and, when entity
+        (the key_singular of households or of another group entity) is given, only for the members of the groups having
+        unconverged rows.
+        """
+        holder = self.get_or_new_holder(column_name)
+        rows_entity = holder.entity
+        assert self.entity_by_column_name[target_column_name] is rows_entity, \
+            u"Columns {} and {} don't belong to the same entity".format(column_name, target_column_name).encode('utf-8')
+        input_array = holder.calculate()
+        rows_count = rows_entity.count
+        targets = np.asarray(targets, dtype = np.float64) + np.zeros(rows_count)
+        if entity is not None:
+            household_entity = self.entity_by_key_singular[entity]
+            persons = self.persons
+            persons_household_index = persons.holder_by_name['id' + household_entity.symbol].array
+
+        def evaluate(rows, values):
+            if entity is None:
+                simulation = self.fork()
+                rows_index = None
+            else:
+                if rows_entity is household_entity:
+                    households_index = rows
+                elif rows_entity.is_persons_entity:
+                    households_index = np.unique(persons_household_index[rows])
+                else:
+                    households_index = np.unique(persons_household_index[
+                        np.in1d(persons.holder_by_name['id' + rows_entity.symbol].array, rows)])
+                index_by_key_plural = self.get_households_index_by_key_plural(households_index, entity = entity)
+                simulation = self.select(index_by_key_plural, inputs_only = False)
+                rows_index = index_by_key_plural[rows_entity.key_plural]
+                rows = np.searchsorted(rows_index, rows)
+            array = input_array.copy() if rows_index is None else input_array[rows_index]
+            array[rows] = values
+            simulation.set_input(column_name, array)
+            return simulation.calculate(target_column_name)[rows] - targets[rows]
+
+        solution = np.empty(rows_count)
+        solution.fill(np.nan)
+        rows = np.arange(rows_count)
+        lower = np.asarray(lower, dtype = np.float64) + np.zeros(rows_count)
+        upper = np.asarray(upper, dtype = np.float64) + np.zeros(rows_count)
+        lower_error = evaluate(rows, lower)
+        upper_error = evaluate(rows, upper)
+        for bound, error in ((lower, lower_error), (upper, upper_error)):
+            converged = np.abs(error) <= tolerance
+            solution[converged] = bound[converged]
+        active = np.isnan(solution) & (np.sign(lower_error) != np.sign(upper_error))
+        rows = rows[active]
+        lower, upper, lower_error, upper_error = lower[active], upper[active], lower_error[active], upper_error[active]
+        for iteration in xrange(max_iterations):
+            if rows.size == 0:
+                break
+            if iteration % 2 == 0:
+                values = lower - lower_error * (upper - lower) / (upper_error - lower_error)
+            else:
+                values = (lower + upper) / 2
+            error = evaluate(rows, values)
+            converged = np.abs(error) <= tolerance
+            solution[rows[converged]] = values[converged]
+            same_side = np.sign(error) == np.sign(lower_error)
+            lower = np.where(same_side, values, lower)
+            lower_error = np.where(same_side, error, lower_error)
+            upper = np.where(same_side, upper, values)
+            upper_error = np.where(same_side, upper_error, error)
+            active = ~converged
+            rows = rows[active]
+            lower, upper, lower_error, upper_error = lower[active], upper[active], lower_error[active], \
+                upper_error[active]
+        return solution
+
+    def sort_persons(self, entity):
+        """Reorder persons so that the members of each household (or any other group entity) are contiguous.
+
+        Persons are sorted by household, then by the other group entities, then by role in household. The other group
+        entities are renumbered in order of appearance, so that their members are contiguous too when they are
+        contained in households. This allows role helpers of formulas to use contiguous reductions. The original
+        positions are kept in permutation_by_key_plural (see method restore_order).
+        """
+        household_entity = self.entity_by_key_singular[entity]
+        persons = self.persons
+        other_entities = [
+            other_entity
+            for other_entity in self.entity_by_key_plural.itervalues()
+            if not other_entity.is_persons_entity and other_entity is not household_entity
+            ]
+        persons_holder_by_name = persons.holder_by_name
+        persons_permutation = np.lexsort(
+            [persons_holder_by_name['qui' + household_entity.symbol].array] + [
+                persons_holder_by_name['id' + other_entity.symbol].array
+                for other_entity in reversed(other_entities)
+                ] + [persons_holder_by_name['id' + household_entity.symbol].array])
+        permutation_by_key_plural = self.permutation_by_key_plural
+        if permutation_by_key_plural is None:
+            permutation_by_key_plural = {}
+        else:
+            permutation_by_key_plural = dict(
+                (key_plural, permutation[persons_permutation] if key_plural == persons.key_plural else permutation)
+                for key_plural, permutation in permutation_by_key_plural.iteritems()
+                )
+        permutation_by_key_plural.setdefault(persons.key_plural, persons_permutation)
+        self._permute_entity(persons, persons_permutation)
+        for other_entity in other_entities:
+            index_holder = persons_holder_by_name['id' + other_entity.symbol]
+            index_array = index_holder.array
+            first_positions = np.unique(index_array, return_index = True)[1]
+            permutation = index_array[np.sort(first_positions)]
+            # Groups without members are kept at the end.
+            unused = np.ones(other_entity.count, dtype = np.bool)
+            unused[permutation] = False
+            permutation = np.concatenate((permutation, np.nonzero(unused)[0])).astype(index_array.dtype)
+            new_index_by_index = np.empty_like(permutation)
+            new_index_by_index[permutation] = np.arange(permutation.size, dtype = permutation.dtype)
+            index_holder.array = new_index_by_index[index_array]
+            self._permute_entity(other_entity, permutation)
+            original_permutation = permutation_by_key_plural.get(other_entity.key_plural)
+            permutation_by_key_plural[other_entity.key_plural] = permutation if original_permutation is None \
+                else original_permutation[permutation]
+        self.permutation_by_key_plural = permutation_by_key_plural
+
+    def step(self, date, transitions = None, compact_legislation = None):
+        """Advance a dynamic simulation to a new date, carrying its state forward in place.
+
+        transitions gives, by name of state (input) column, a function receiving the simulation (still at its current
+        date) and returning the array of the column at the new date. Every transition is evaluated before any state
+        changes. Then the simulation moves to the new date, forgetting the computed arrays of the previous date, and
+        only the consumers of the changed state columns are invalidated.
+        """
+        array_by_column_name = dict(
+            (column_name, transition(self))
+            for column_name, transition in (transitions or {}).iteritems()
+            )
+        self.set_date(date, compact_legislation = compact_legislation, keep_computed_arrays = False)
+        for column_name, array in array_by_column_name.iteritems():
+            self.set_input(column_name, array)
+
+    def sweep(self, axes, column_names):
+        """Calculate columns for every point of a grid of input values, using a single vectorised simulation.
+
+        Each axis is a dictionary with keys "name" (an input column), "min", "max", "count" and optionally "index"
+        (position in its entity of the test case member to vary, default 0). The test case is replicated once for each
+        point of the grid. Returns the arrays of the requested columns, reshaped to (axis 1 count, axis 2 count, ...,
+        entity count of test case).
+        """
+        counts = tuple(axis['count'] for axis in axes)
+        steps_count = int(np.prod(counts))
+        new = self.replicate(steps_count)
+        grid_index_by_axis = np.unravel_index(np.arange(steps_count), counts)
+        for axis, grid_index in zip(axes, grid_index_by_axis):
+            column_name = axis['name']
+            holder = new.get_or_new_holder(column_name)
+            entity = holder.entity
+            array = holder.calculate().copy()
+            values = np.linspace(axis['min'], axis['max'], axis['count'])
+            array[np.arange(steps_count) * entity.step_size + axis.get('index', 0)] = values[grid_index]
+            new.set_input(column_name, array)
+        array_by_column_name = {}
+        for column_name in column_names:
+            holder = new.compute(column_name)
+            array_by_column_name[column_name] = holder.array.reshape(counts + (holder.entity.step_size,))
+        return array_by_column_name
+
+
+class SimulationTemplate(object):
+    """Static data shared by every simulation of a tax-benefit system at a given date
+
+    Use AbstractTaxBenefitSystem.get_simulation_template(date) to get the (cached) template. A template is cached while
+    a simulation uses it, or while its date is among the last used ones.
+    """
+    column_names_by_entity_key_plural = None
+    compact_legislation = None
+    date = None
+    entity_class_by_key_plural = None
+    entity_key_plural_by_key_singular = None
+    persons_key_plural = None
+    tax_benefit_system = None
+
+    def __init__(self, date = None, tax_benefit_system = None):
+        assert date is not None
+        self.date = date
+        assert tax_benefit_system is not None
+        self.tax_benefit_system = tax_benefit_system
+
+        self.compact_legislation = tax_benefit_system.get_compact_legislation(date)
+        self.entity_class_by_key_plural = entity_class_by_key_plural = tax_benefit_system.entity_class_by_key_plural
+        self.column_names_by_entity_key_plural = dict(
+            (key_plural, tuple(entity_class.column_by_name.iterkeys()))
+            for key_plural, entity_class in entity_class_by_key_plural.iteritems()
+            )
+        self.entity_key_plural_by_key_singular = dict(
+            (entity_class.key_singular, key_plural)
+            for key_plural, entity_class in entity_class_by_key_plural.iteritems()
+            )
+        for key_plural, entity_class in entity_class_by_key_plural.iteritems():
+            if entity_class.is_persons_entity:
+                self.persons_key_plural = key_plural
+                break
+
+    def new_simulation(self, **kwargs):
+        return Simulation(date = self.date, tax_benefit_system = self.tax_benefit_system, **kwargs)
+
+
+def _mix64(values):
+    """Scramble an array of 64 bits unsigned integers (finalizer of SplitMix64)."""
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
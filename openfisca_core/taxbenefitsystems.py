@@ -23,10 +23,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import collections
+import cPickle
+import os
 import xml.etree.ElementTree
 import weakref
 
-from . import conv, legislations, legislationsxml
+from . import conv, legislations, legislationsxml, simulations
 
 
 __all__ = ['AbstractTaxBenefitSystem']
@@ -37,6 +40,8 @@ class AbstractTaxBenefitSystem(object):
     column_by_name = None
     columns_name_tree_by_entity = None
     compact_legislation_by_date_str_cache = None
+    date_dependent_column_names = None
+    dependencies_by_column_name = None  # Inverse of Column.consumers
     entities = None  # class attribute
     ENTITIES_INDEX = None  # class attribute
     entity_class_by_key_plural = None  # class attribute
@@ -48,7 +53,10 @@ class AbstractTaxBenefitSystem(object):
     legislation_json_by_xml_file_path = {}  # class attribute
     PARAM_FILE = None  # class attribute
     prestation_by_name = None
+    recent_simulation_template_by_date_str = None  # Strong cache of the last used templates, kept between simulations
+    recent_simulation_templates_count = 4  # Size of recent_simulation_template_by_date_str
     Scenario = None
+    simulation_template_by_date_str = None  # Weak cache of the templates used by simulations
 
     def __init__(self):
         # Merge prestation_by_name into column_by_name, because it is no more used.
@@ -99,6 +107,75 @@ class AbstractTaxBenefitSystem(object):
             self.compact_legislation_by_date_str_cache[date_str] = compact_legislation
         return compact_legislation
 
+    def get_consumers_closure(self, column_names):
+        """Return the names of the columns that depend, directly or indirectly, on the given columns."""
+        column_by_name = self.column_by_name
+        consumers_closure = set()
+        pending_names = list(column_names)
+        while pending_names:
+            for consumer in column_by_name[pending_names.pop()].consumers or []:
+                if consumer not in consumers_closure:
+                    consumers_closure.add(consumer)
+                    pending_names.append(consumer)
+        return consumers_closure
+
+    def get_date_dependent_column_names(self):
+        """Return the names of the columns whose values may change with the date, when their inputs don't change."""
+        date_dependent_column_names = self.date_dependent_column_names
+        if date_dependent_column_names is None:
+            date_dependent_column_names = set(
+                column.name
+                for column in self.column_by_name.itervalues()
+                if column.start is not None or column.end is not None
+                    or column.formula_constructor is not None and column.formula_constructor.is_date_dependent()
+                )
+            date_dependent_column_names.update(self.get_consumers_closure(date_dependent_column_names))
+            self.date_dependent_column_names = date_dependent_column_names = frozenset(date_dependent_column_names)
+        return date_dependent_column_names
+
+    def get_dependencies_closure(self, column_names):
+        """Return the names of the columns that the given columns depend on, directly or indirectly."""
+        dependencies_by_column_name = self.dependencies_by_column_name
+        if dependencies_by_column_name is None:
+            self.dependencies_by_column_name = dependencies_by_column_name = {}
+            for column in self.column_by_name.itervalues():
+                for consumer in column.consumers or []:
+                    dependencies_by_column_name.setdefault(consumer, set()).add(column.name)
+        dependencies_closure = set()
+        pending_names = list(column_names)
+        while pending_names:
+            for dependency in dependencies_by_column_name.get(pending_names.pop(), []):
+                if dependency not in dependencies_closure:
+                    dependencies_closure.add(dependency)
+                    pending_names.append(dependency)
+        return dependencies_closure
+
+    def get_simulation_template(self, date):
+        """Return the template shared by the simulations of a date.
+
+        Templates are kept as long as a simulation uses them, and the ones of the last used dates are kept too, so
+        that successive requests (of a web API for example) don't rebuild them.
+        """
+        date_str = date.isoformat()
+        simulation_template_by_date_str = self.simulation_template_by_date_str
+        if simulation_template_by_date_str is None:
+            self.simulation_template_by_date_str = simulation_template_by_date_str = weakref.WeakValueDictionary()
+        simulation_template = simulation_template_by_date_str.get(date_str)
+        if simulation_template is None:
+            simulation_template_by_date_str[date_str] = simulation_template = simulations.SimulationTemplate(
+                date = date,
+                tax_benefit_system = self,
+                )
+        recent_simulation_template_by_date_str = self.recent_simulation_template_by_date_str
+        if recent_simulation_template_by_date_str is None:
+            self.recent_simulation_template_by_date_str = recent_simulation_template_by_date_str = \
+                collections.OrderedDict()
+        recent_simulation_template_by_date_str.pop(date_str, None)
+        recent_simulation_template_by_date_str[date_str] = simulation_template
+        while len(recent_simulation_template_by_date_str) > self.recent_simulation_templates_count:
+            recent_simulation_template_by_date_str.popitem(last = False)
+        return simulation_template
+
     @classmethod
     def json_to_instance(cls, value, state = None):
         attributes, error = conv.pipe(
@@ -109,10 +186,78 @@ class AbstractTaxBenefitSystem(object):
             return attributes, error
         return cls(**attributes), None
 
+    @classmethod
+    def load_snapshot(cls, path):
+        """Return a new tax-benefit system initialized from a snapshot written by method save_snapshot.
+
+        The legislation is not parsed and validated again and the dependencies between columns are restored, so this is
+        the fast way to create tax-benefit systems in worker processes. Only the consumers of each column are still
+        set by the constructor: this pass takes about 15 ms for 2,000 formulas of 6 parameters.
+
+        Raises ValueError when the snapshot doesn't match the tax-benefit system or is older than its legislation.
+        """
+        with open(path, 'rb') as snapshot_file:
+            snapshot = cPickle.load(snapshot_file)
+        legislation_xml_file_path = snapshot['legislation_xml_file_path']
+        if legislation_xml_file_path != cls.PARAM_FILE:
+            raise ValueError(u"Snapshot {} was made with legislation {} instead of {}".format(path,
+                legislation_xml_file_path, cls.PARAM_FILE).encode('utf-8'))
+        legislation_json = snapshot['legislation_json']
+        legislation_json_by_xml_file_path = cls.legislation_json_by_xml_file_path
+        original_legislation_json = legislation_json_by_xml_file_path.get(legislation_xml_file_path)
+        if snapshot['is_reformed']:
+            # Temporarily use the reformed legislation, to avoid parsing the original one.
+            legislation_json_by_xml_file_path[legislation_xml_file_path] = legislation_json
+        else:
+            if legislation_xml_file_path is not None \
+                    and os.path.getmtime(legislation_xml_file_path) != snapshot['legislation_xml_file_mtime']:
+                raise ValueError(u"Snapshot {} is older than legislation {}".format(path,
+                    legislation_xml_file_path).encode('utf-8'))
+            if original_legislation_json is None:
+                legislation_json_by_xml_file_path[legislation_xml_file_path] = legislation_json
+        try:
+            tax_benefit_system = cls()
+        finally:
+            if snapshot['is_reformed']:
+                if original_legislation_json is None:
+                    del legislation_json_by_xml_file_path[legislation_xml_file_path]
+                else:
+                    legislation_json_by_xml_file_path[legislation_xml_file_path] = original_legislation_json
+        if sorted(tax_benefit_system.column_by_name) != snapshot['column_names']:
+            raise ValueError(u"Snapshot {} doesn't have the same columns as tax-benefit system".format(path).encode(
+                'utf-8'))
+        tax_benefit_system.legislation_json = legislation_json
+        tax_benefit_system.date_dependent_column_names = snapshot['date_dependent_column_names']
+        tax_benefit_system.dependencies_by_column_name = snapshot['dependencies_by_column_name']
+        return tax_benefit_system
+
     def new_scenario(self):
         scenario = self.Scenario()
         scenario.tax_benefit_system = self
         return scenario
 
+    def save_snapshot(self, path):
+        """Save the validated legislation and the dependencies between columns, to be reloaded by load_snapshot."""
+        legislation_xml_file_path = self.PARAM_FILE
+        self.get_date_dependent_column_names()
+        self.get_dependencies_closure([])
+        snapshot = dict(
+            column_names = sorted(self.column_by_name),
+            date_dependent_column_names = self.date_dependent_column_names,
+            dependencies_by_column_name = self.dependencies_by_column_name,
+            is_reformed = self.legislation_json is not self.legislation_json_by_xml_file_path.get(
+                legislation_xml_file_path),
+            legislation_json = self.legislation_json,
+            legislation_xml_file_mtime = os.path.getmtime(legislation_xml_file_path)
+                if legislation_xml_file_path is not None else None,
+            legislation_xml_file_path = legislation_xml_file_path,
+            )
+        temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temporary_path, 'wb') as snapshot_file:
+            cPickle.dump(snapshot, snapshot_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temporary_path, path)
+
     def update_legislation(self):
         self.compact_legislation_by_date_str_cache = weakref.WeakValueDictionary()
+        self.recent_simulation_template_by_date_str = None
+        self.simulation_template_by_date_str = None
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Minimal tax-benefit system used by tests"""
+
+
+import collections
+import datetime
+import os
+
+import numpy as np
+
+from .. import accessors, columns, entities, formulas, simulations, taxbenefitsystems
+
+
+column_by_name = collections.OrderedDict()
+prestation_by_name = collections.OrderedDict()
+
+
+def build_column(name, column, requires_other_dates = False):
+    column.name = name
+    if column.function is None:
+        column_by_name[name] = column
+    else:
+        formula_class = type(name.encode('utf-8'), (formulas.SimpleFormula,), dict(
+            function = staticmethod(column.function),
+            requires_other_dates = requires_other_dates,
+            ))
+        formula_class.extract_parameters()
+        column.formula_constructor = formula_class
+        prestation_by_name[name] = column
+
+
+# Input columns
+
+
+build_column('age', columns.AgeCol())
+build_column('idmen', columns.IntCol())
+build_column('quimen', columns.IntCol())
+build_column('salaire', columns.FloatCol())
+
+
+# Formulas
+
+
+def alea(self, salaire):
+    return salaire * self.get_random()
+
+build_column('alea', columns.FloatCol(function = alea))
+
+
+def alea_menage(self, alea_holder):
+    return self.sum_by_entity(alea_holder) + self.get_random(draw = 1)
+
+build_column('alea_menage', columns.FloatCol(entity = 'men', function = alea_menage))
+
+
+def impot(salaire, taux = accessors.law.ir.taux):
+    return salaire * taux
+
+build_column('impot', columns.FloatCol(function = impot))
+
+
+def impot_cumule(self, impot):
+    date = self.holder.entity.simulation.date
+    return impot + self.calculate_at_date('impot', datetime.date(date.year - 1, date.month, date.day))
+
+build_column('impot_cumule', columns.FloatCol(function = impot_cumule), requires_other_dates = True)
+
+
+def impot_menage(self, impot_holder):
+    return self.sum_by_entity(impot_holder)
+
+build_column('impot_menage', columns.FloatCol(entity = 'men', function = impot_menage))
+
+
+def revenu_disponible(revenu_menage, impot_menage, _P):
+    return revenu_menage - impot_menage + _P.ir.bonus
+
+build_column('revenu_disponible', columns.FloatCol(entity = 'men', function = revenu_disponible))
+
+
+def revenu_menage(self, salaire_net_holder):
+    return self.sum_by_entity(salaire_net_holder)
+
+build_column('revenu_menage', columns.FloatCol(entity = 'men', function = revenu_menage))
+
+
+def salaire_net(salaire):
+    return salaire * 0.8
+
+build_column('salaire_net', columns.FloatCol(function = salaire_net))
+
+
+# Entities
+
+
+class Individus(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    is_persons_entity = True
+    key_plural = 'individus'
+    key_singular = 'individu'
+    symbol = 'ind'
+
+
+class Menages(entities.AbstractEntity):
+    column_by_name = collections.OrderedDict()
+    key_plural = 'menages'
+    key_singular = 'menage'
+    symbol = 'men'
+
+
+entity_class_by_symbol = dict(
+    (entity_class.symbol, entity_class)
+    for entity_class in (Individus, Menages)
+    )
+for column in column_by_name.values() + prestation_by_name.values():
+    entity_class_by_symbol[column.entity].column_by_name[column.name] = column
+
+
+# Tax-benefit system
+
+
+class DummyTaxBenefitSystem(taxbenefitsystems.AbstractTaxBenefitSystem):
+    column_by_name = column_by_name
+    entity_class_by_key_plural = dict(
+        (entity_class.key_plural, entity_class)
+        for entity_class in entity_class_by_symbol.itervalues()
+        )
+    PARAM_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dummy_country.xml')
+    preprocess_legislation_parameters = None
+    prestation_by_name = prestation_by_name
+
+
+def new_simulation(tax_benefit_system, households_count, date = datetime.date(2014, 1, 1), seed = 0,
+        shuffle_persons = False, **kwargs):
+    """Return a simulation of households of 1 to 3 persons, with random inputs drawn from seed.
+
+    Persons are sorted by household, unless shuffle_persons is True (like in some surveys).
+    """
+    random_state = np.random.RandomState(seed)
+    sizes = random_state.randint(1, 4, households_count)
+    simulation = simulations.Simulation(date = date, tax_benefit_system = tax_benefit_system, **kwargs)
+    persons_count = sizes.sum()
+    simulation.persons.count = simulation.persons.step_size = persons_count
+    menages = simulation.entity_by_key_plural['menages']
+    menages.count = menages.step_size = households_count
+    menages.roles_count = 3
+    array_by_column_name = dict(
+        age = random_state.randint(0, 80, persons_count).astype(np.int32),
+        idmen = np.repeat(np.arange(households_count), sizes).astype(np.int32),
+        quimen = np.concatenate([
+            np.arange(size)
+            for size in sizes
+            ]).astype(np.int32),
+        salaire = (random_state.rand(persons_count) * 30000).astype(np.float32),
+        )
+    permutation = random_state.permutation(persons_count) if shuffle_persons else None
+    for column_name, array in sorted(array_by_column_name.iteritems()):
+        simulation.get_or_new_holder(column_name).array = array if permutation is None else array[permutation]
+    return simulation
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the merge of several simulations into a single one (see batches.concatenate)."""
+
+
+from .. import batches
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def test_batch_keeps_streams():
+    simulations = [
+        dummy_country.new_simulation(tax_benefit_system, 7, random_seed = 3, seed = seed)
+        for seed in range(3)
+        ]
+    batch, slice_by_key_plural_by_simulation = batches.concatenate(simulations)
+    array = batch.calculate('alea_menage')
+    for simulation, slice_by_key_plural in zip(simulations, slice_by_key_plural_by_simulation):
+        assert (array[slice_by_key_plural['menages']] == simulation.calculate('alea_menage')).all()
+
+
+def test_batch_equals_serial():
+    simulations = [
+        dummy_country.new_simulation(tax_benefit_system, 7, seed = seed, shuffle_persons = seed % 2 == 1)
+        for seed in range(3)
+        ]
+    batch, slice_by_key_plural_by_simulation = batches.concatenate(simulations)
+    array = batch.calculate('revenu_disponible')
+    for simulation, slice_by_key_plural in zip(simulations, slice_by_key_plural_by_simulation):
+        assert (array[slice_by_key_plural['menages']] == simulation.calculate('revenu_disponible')).all()
+
+
+if __name__ == '__main__':
+    test_batch_equals_serial()
+    test_batch_keeps_streams()
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the keys of the on-disk cache of computed arrays (see caches.ResultCache)."""
+
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from .. import caches, columns, formulas, legislations
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def get_key(simulation, column_name):
+    return caches.ResultCache(tempfile.gettempdir()).get_key(simulation.get_or_new_holder(column_name))
+
+
+def test_cache_hit():
+    directory = tempfile.mkdtemp(prefix = 'openfisca-')
+    try:
+        result_cache = caches.ResultCache(directory)
+        simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+        simulation.result_cache = result_cache
+        array = simulation.calculate('revenu_disponible')
+        # Store another array under the key, to check that it is read instead of being recomputed.
+        other_simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+        result_cache.put(result_cache.get_key(other_simulation.get_or_new_holder('revenu_disponible')), array + 1)
+        other_simulation.result_cache = result_cache
+        assert (other_simulation.calculate('revenu_disponible') == array + 1).all()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_key_depends_on_inputs():
+    key = get_key(dummy_country.new_simulation(tax_benefit_system, 10), 'revenu_disponible')
+    assert key is not None
+    assert get_key(dummy_country.new_simulation(tax_benefit_system, 10), 'revenu_disponible') == key
+    assert get_key(dummy_country.new_simulation(tax_benefit_system, 10, seed = 1), 'revenu_disponible') != key
+
+
+def test_key_depends_on_random_seed():
+    key = get_key(dummy_country.new_simulation(tax_benefit_system, 10), 'alea_menage')
+    assert key is not None
+    assert get_key(dummy_country.new_simulation(tax_benefit_system, 10, random_seed = 1), 'alea_menage') != key
+
+
+def test_key_depends_on_used_parameters():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    reform = simulation.fork(compact_legislation = legislations.patch_compact_node(simulation.compact_legislation,
+        ('ir', 'bonus'), 100))
+    assert get_key(reform, 'revenu_disponible') != get_key(simulation, 'revenu_disponible')
+    assert get_key(reform, 'impot_menage') == get_key(simulation, 'impot_menage')
+
+
+def test_uncachable_formulas():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    assert get_key(simulation, 'impot_cumule') is None
+    namespace = {}
+    exec 'def function(salaire):\n    return salaire * 2\n' in namespace
+    column = columns.FloatCol(function = namespace['function'])
+    column.name = u'interactive'
+    column.formula_constructor = type('interactive', (formulas.SimpleFormula,), dict(
+        function = staticmethod(namespace['function']),
+        ))
+    assert caches.ResultCache(tempfile.gettempdir()).get_formulas_digest(column) is None
+
+
+if __name__ == '__main__':
+    test_cache_hit()
+    test_key_depends_on_inputs()
+    test_key_depends_on_random_seed()
+    test_key_depends_on_used_parameters()
+    test_uncachable_formulas()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the calculation of a simulation by chunks of households (see Simulation.calculate_by_chunks)."""
+
+
+import numpy as np
+
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def test_chunks_keep_streams():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 100, random_seed = 3)
+    array = simulation.fork().calculate('alea_menage')
+    chunks_array = np.concatenate([
+        array_by_column_name['alea_menage']
+        for index_by_key_plural, array_by_column_name in simulation.calculate_by_chunks(['alea_menage'],
+            chunk_size = 17, entity = 'menage')
+        ])
+    assert (chunks_array == array).all()
+
+
+def test_households_members():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 50, shuffle_persons = True)
+    households_members = simulation.get_households_members('menage')
+    for households_index in (np.arange(0), np.arange(7, 19), np.array([3, 42, 11])):
+        index_by_key_plural = simulation.get_households_index_by_key_plural(households_index, entity = 'menage')
+        fast_index_by_key_plural = simulation.get_households_index_by_key_plural(households_index, entity = 'menage',
+            households_members = households_members)
+        assert sorted(fast_index_by_key_plural) == sorted(index_by_key_plural)
+        for key_plural, index in index_by_key_plural.iteritems():
+            assert (fast_index_by_key_plural[key_plural] == index).all(), key_plural
+
+
+if __name__ == '__main__':
+    test_chunks_keep_streams()
+    test_households_members()
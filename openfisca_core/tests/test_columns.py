@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the columns of strings, stored as codes of categories (see columns.StrCol)."""
+
+
+import numpy as np
+
+from .. import columns
+
+
+def new_column():
+    column = columns.StrCol()
+    column.name = u'depcom'
+    return column
+
+
+def test_encode_codes():
+    column = new_column()
+    codes = column.encode([u'75056', u'69123'])
+    assert (column.encode(codes) == codes).all()
+    try:
+        column.encode(np.array([75056], dtype = np.int32))
+    except ValueError:
+        pass
+    else:
+        assert False, 'Unknown codes must be rejected'
+
+
+def test_encode_strings():
+    column = new_column()
+    codes = column.encode(np.array([u'75056', u'69123', u'75056']))
+    assert codes.dtype == column.dtype
+    assert codes[0] == codes[2] != codes[1]
+    assert column.decode(codes).tolist() == [u'75056', u'69123', u'75056']
+    assert column.equal(codes, u'69123').tolist() == [False, True, False]
+    assert column.isin(codes, [u'75056', u'13055']).tolist() == [True, False, True]
+
+
+if __name__ == '__main__':
+    test_encode_codes()
+    test_encode_strings()
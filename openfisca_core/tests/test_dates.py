@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the calculation of arrays at other dates (aka periods) than the current date of a simulation."""
+
+
+import datetime
+
+import numpy as np
+
+from .. import legislations, reforms
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+date_2013 = datetime.date(2013, 1, 1)
+
+
+def test_calculate_at_other_date():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    salaire = simulation.calculate('salaire')
+    assert np.allclose(simulation.calculate('impot', date = date_2013), salaire * 0.1)
+    assert simulation.date == datetime.date(2014, 1, 1)
+    assert np.allclose(simulation.calculate('impot'), salaire * 0.2)
+    assert np.allclose(simulation.calculate('impot_cumule'), salaire * 0.3)
+
+
+def test_calculate_reform_at_other_date():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    salaire = simulation.calculate('salaire')
+    comparison = reforms.ReformComparison(simulation,
+        legislations.patch_compact_node(simulation.compact_legislation, ('ir', 'taux'), 0.3),
+        reform_compact_legislation_getter = tax_benefit_system.get_compact_legislation)
+    baseline_array, reform_array, difference = comparison.calculate('impot_cumule')
+    assert np.allclose(baseline_array, salaire * 0.3)
+    assert np.allclose(reform_array, salaire * 0.4)
+    assert np.allclose(comparison.reform.fork().calculate('impot_cumule'), salaire * 0.4)
+
+
+def test_set_input_at_other_date():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    salaire = simulation.calculate('salaire')
+    simulation.set_input('salaire', salaire * 2, date = date_2013)
+    assert np.allclose(simulation.calculate('impot', date = date_2013), salaire * 0.2)
+    assert np.allclose(simulation.calculate('impot_cumule'), salaire * 0.4)
+    assert (simulation.calculate('salaire') == salaire).all()
+
+
+def test_set_input_invalidates_other_dates():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    salaire = simulation.calculate('salaire')
+    simulation.calculate('impot', date = date_2013)
+    simulation.set_input('salaire', salaire * 2)
+    assert np.allclose(simulation.calculate('impot', date = date_2013), salaire * 0.2)
+
+
+def test_set_date():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    salaire = simulation.calculate('salaire')
+    simulation.calculate('impot')
+    simulation.set_date(date_2013)
+    assert np.allclose(simulation.calculate('impot'), salaire * 0.1)
+    assert (simulation.calculate('salaire') == salaire).all()
+
+
+def test_solve_parameter_at_other_date():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    target = float(np.sum(simulation.calculate('salaire'), dtype = np.float64)) * 0.5
+    value = reforms.solve_parameter(simulation, 'ir.taux', 'impot_cumule', 0, 1, target = target)
+    assert abs(value - 0.25) < 1e-3, value
+
+
+def test_set_date_keeps_arrays():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    revenu_menage = simulation.calculate('revenu_menage')
+    impot = simulation.calculate('impot')
+    simulation.set_date(date_2013)
+    # Date-invariant arrays are shared by every date, while the other ones are kept by date.
+    assert simulation.calculate('revenu_menage') is revenu_menage
+    assert not np.allclose(simulation.calculate('impot'), impot)
+    simulation.set_date(datetime.date(2014, 1, 1))
+    assert simulation.calculate('impot') is impot
+    simulation.set_date(date_2013, keep_computed_arrays = False)
+    simulation.set_date(datetime.date(2014, 1, 1))
+    assert simulation.calculate('revenu_menage') is revenu_menage
+    assert simulation.get_holder('impot').array is None
+
+
+def test_step():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10, date = date_2013)
+    salaire = simulation.calculate('salaire')
+    age = simulation.calculate('age')
+    assert np.allclose(simulation.calculate('impot'), salaire * 0.1)
+    simulation.step(datetime.date(2014, 1, 1), transitions = dict(
+        age = lambda simulation: simulation.calculate('age') + 1,
+        salaire = lambda simulation: simulation.calculate('salaire') + simulation.calculate('impot'),
+        ))
+    assert simulation.date == datetime.date(2014, 1, 1)
+    assert (simulation.calculate('age') == age + 1).all()
+    assert np.allclose(simulation.calculate('impot'), salaire * 1.1 * 0.2)
+    assert not simulation.get_holder('impot').array_by_date
+
+
+if __name__ == '__main__':
+    test_calculate_at_other_date()
+    test_calculate_reform_at_other_date()
+    test_set_input_at_other_date()
+    test_set_input_invalidates_other_dates()
+    test_set_date()
+    test_solve_parameter_at_other_date()
+    test_set_date_keeps_arrays()
+    test_step()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the calculation of a simulation for several dates (see planners.calculate_by_dates)."""
+
+
+import datetime
+
+import numpy as np
+
+from .. import planners
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+column_names = ['impot', 'revenu_disponible', 'salaire_net']
+dates = [datetime.date(2013, 1, 1), datetime.date(2014, 1, 1), datetime.date(2015, 1, 1)]
+
+
+def check_calculate_by_dates(processes_count):
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    array_by_column_name_by_date = planners.calculate_by_dates(simulation, column_names, dates,
+        processes_count = processes_count)
+    assert sorted(array_by_column_name_by_date) == dates
+    for date in dates:
+        date_simulation = dummy_country.new_simulation(tax_benefit_system, 10, date = date)
+        for column_name in column_names:
+            assert np.allclose(array_by_column_name_by_date[date][column_name],
+                date_simulation.calculate(column_name)), (date, column_name)
+    assert simulation.get_holder('impot', None) is None
+
+
+def test_calculate_by_dates():
+    check_calculate_by_dates(None)
+
+
+def test_calculate_by_dates_with_processes():
+    check_calculate_by_dates(2)
+
+
+def test_plan():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    invariant_column_names, dependent_column_names = planners.plan(simulation, ['revenu_disponible'])
+    assert invariant_column_names == set(['revenu_menage', 'salaire', 'salaire_net'])
+    assert dependent_column_names == set(['impot', 'impot_menage', 'revenu_disponible'])
+
+
+if __name__ == '__main__':
+    test_calculate_by_dates()
+    test_calculate_by_dates_with_processes()
+    test_plan()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check that random streams (see Simulation.get_random) don't depend on how a simulation is split or merged."""
+
+
+import numpy as np
+
+from .. import shards
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def test_replicate_shares_streams():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10, random_seed = 3)
+    array = simulation.calculate('alea_menage')
+    replicated_array = simulation.replicate(3).calculate('alea_menage')
+    assert (replicated_array == np.tile(array, 3)).all()
+    selected = simulation.select(simulation.get_households_index_by_key_plural(np.arange(10), entity = 'menage'))
+    assert (selected.replicate(3).calculate('alea_menage') == replicated_array).all()
+
+
+def test_shards_keep_streams():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 100, random_seed = 3, shuffle_persons = True)
+    array_by_column_name = shards.calculate_with_processes(simulation, ['alea', 'alea_menage'], entity = 'menage',
+        processes_count = 2, shards_count = 5)
+    for column_name in ('alea', 'alea_menage'):
+        assert (array_by_column_name[column_name] == simulation.calculate(column_name)).all(), column_name
+
+
+if __name__ == '__main__':
+    test_replicate_shares_streams()
+    test_shards_keep_streams()
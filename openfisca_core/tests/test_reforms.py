@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import numpy as np
+
+from .. import legislations, reforms, taxscales
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def test_changed_tax_scale_constant_amounts():
+    compact_node = legislations.CompactNode()
+    compact_node.scale = scale = taxscales.TaxScale()
+    scale.add_bracket(0, 0.1)
+    other_scale = taxscales.TaxScale(constant_amount_option = True)
+    other_scale.add_bracket(0, 0.1)
+    assert other_scale == scale
+    other_compact_node = legislations.patch_compact_node(compact_node, ('scale',), other_scale)
+    assert list(legislations.iter_changed_paths(compact_node, other_compact_node)) == [('scale',)]
+
+
+def test_comparison_shares_unaffected_columns():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 20)
+    # Baseline is calculated before the comparison exists, so without recording legislation paths.
+    simulation.calculate('revenu_disponible')
+    comparison = reforms.ReformComparison(simulation, legislations.patch_compact_node(simulation.compact_legislation,
+        ('ir', 'bonus'), 100))
+    baseline_array, reform_array, difference = comparison.calculate('revenu_disponible')
+    assert (difference == 90).all()
+    # impot_cumule uses other dates (and is not called by baseline).
+    assert comparison.get_affected_column_names() == set(['impot_cumule', 'revenu_disponible'])
+    assert comparison.reform.get_holder('impot_menage').array is simulation.get_holder('impot_menage').array
+
+
+def test_recording_simulation_keeps_computed_arrays():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 20, record_legislation_paths = True)
+    impot_array = simulation.calculate('impot')
+    simulation.calculate('revenu_disponible')
+    comparison = reforms.ReformComparison(simulation, legislations.patch_compact_node(simulation.compact_legislation,
+        ('ir', 'taux'), 0.5))
+    assert simulation.get_holder('impot').array is impot_array
+    assert comparison.get_affected_column_names() == set(['impot', 'impot_cumule', 'impot_menage', 'revenu_disponible'])
+
+
+def test_solve_parameter():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 20)
+    salaire_total = float(np.sum(simulation.calculate('salaire'), dtype = np.float64))
+    impot = simulation.calculate('impot')
+    # Revenue-neutral value is the one of baseline.
+    value = reforms.solve_parameter(simulation, 'ir.taux', 'impot', 0, 1)
+    assert abs(value - 0.2) < 1e-3, value
+    value = reforms.solve_parameter(simulation, 'ir.taux', 'impot', 0, 1, target = salaire_total * 0.35)
+    assert abs(value - 0.35) < 1e-3, value
+    # Baseline is left unchanged.
+    assert (simulation.calculate('impot') == impot).all()
+    try:
+        reforms.solve_parameter(simulation, 'ir.taux', 'impot', 0.5, 1)
+    except AssertionError:
+        pass
+    else:
+        assert False, "Bounds that don't bracket target must be refused"
+
+
+if __name__ == '__main__':
+    test_changed_tax_scale_constant_amounts()
+    test_comparison_shares_unaffected_columns()
+    test_recording_simulation_keeps_computed_arrays()
+    test_solve_parameter()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the bounded pool of workers calculating simulations (see services.Service)."""
+
+
+import threading
+
+from .. import services
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def new_failing_simulation():
+    raise ValueError('Invalid test case')
+
+
+def new_simulation():
+    return dummy_country.new_simulation(tax_benefit_system, 5)
+
+
+def check_service(service):
+    try:
+        request = service.submit(new_simulation, ['revenu_disponible'])
+        assert (request.get(10)['revenu_disponible'] == new_simulation().calculate('revenu_disponible')).all()
+        request = service.submit(new_failing_simulation, ['revenu_disponible'])
+        try:
+            request.get(10)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Error of request must be raised'
+    finally:
+        service.close()
+
+
+def test_overloaded_service():
+    service = services.Service(max_pending = 1, workers_count = 1)
+    released = threading.Event()
+
+    def new_blocked_simulation():
+        released.wait(10)
+        return new_simulation()
+
+    try:
+        request = service.submit(new_blocked_simulation, ['revenu_disponible'])
+        try:
+            service.submit(new_simulation, ['revenu_disponible'])
+        except services.ServiceOverloadedError:
+            pass
+        else:
+            assert False, 'Service must refuse requests beyond max_pending'
+    finally:
+        released.set()
+    request.get(10)
+    service.close()
+
+
+def test_processes_service():
+    check_service(services.Service(processes = True, workers_count = 2))
+
+
+def test_threads_service():
+    check_service(services.Service(workers_count = 2))
+
+
+if __name__ == '__main__':
+    test_overloaded_service()
+    test_processes_service()
+    test_threads_service()
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import multiprocessing.connection
+import socket
+
+from .. import legislations, shards
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+column_names = ('impot', 'revenu_disponible')
+
+
+def check_sharded_equals_serial(simulation):
+    serial_array_by_column_name = dict(
+        (column_name, simulation.fork().calculate(column_name))
+        for column_name in column_names
+        )
+    array_by_column_name = shards.calculate_with_processes(simulation, column_names, entity = 'menage',
+        processes_count = 2, shards_count = 5)
+    for column_name in column_names:
+        assert (array_by_column_name[column_name] == serial_array_by_column_name[column_name]).all(), column_name
+    return array_by_column_name
+
+
+def test_calculate_with_processes():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 200)
+    check_sharded_equals_serial(simulation)
+
+
+def test_calculate_with_processes_of_reform():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 200)
+    reform = simulation.fork(compact_legislation = legislations.patch_compact_node(simulation.compact_legislation,
+        ('ir', 'taux'), 0.5))
+    array_by_column_name = check_sharded_equals_serial(reform)
+    assert not (array_by_column_name['impot'] == simulation.calculate('impot')).all()
+
+
+def test_calculate_with_workers():
+    free_socket = socket.socket()
+    free_socket.bind(('localhost', 0))
+    address = free_socket.getsockname()
+    free_socket.close()
+    worker = multiprocessing.Process(target = shards.serve_shards, args = (tax_benefit_system, address, 'secret'))
+    worker.daemon = True
+    worker.start()
+    try:
+        simulation = dummy_country.new_simulation(tax_benefit_system, 50)
+        for attempt in range(50):
+            try:
+                multiprocessing.connection.Client(address, authkey = 'secret').close()
+            except socket.error:
+                worker.join(0.1)
+            else:
+                break
+        array_by_column_name = shards.calculate_with_workers(simulation, column_names, [address], 'secret',
+            entity = 'menage', shards_count = 3)
+        for column_name in column_names:
+            assert (array_by_column_name[column_name] == simulation.calculate(column_name)).all(), column_name
+        try:
+            shards.calculate_with_workers(simulation, column_names, [address], None, entity = 'menage')
+        except ValueError:
+            pass
+        else:
+            assert False, 'An authentication key must be required'
+    finally:
+        worker.terminate()
+        worker.join()
+
+
+def test_unsafe_paths():
+    for path in ('/etc/passwd', '../simulation.json', 'menages/../../simulation.json'):
+        try:
+            shards.write_files('.', {path: ''})
+        except ValueError:
+            pass
+        else:
+            assert False, u'Unsafe path {} must be rejected'.format(path)
+
+
+if __name__ == '__main__':
+    test_calculate_with_processes()
+    test_calculate_with_processes_of_reform()
+    test_calculate_with_workers()
+    test_unsafe_paths()
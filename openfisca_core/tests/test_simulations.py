@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the copy, persistence and incremental recalculation of simulations."""
+
+
+import shutil
+import tempfile
+
+import numpy as np
+
+from .. import legislations, simulations
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def test_fork_shares_arrays():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    array = simulation.calculate('revenu_disponible')
+    fork = simulation.fork()
+    assert fork.get_holder('revenu_disponible').array is array
+    salaire = simulation.calculate('salaire')
+    fork.set_input('salaire', salaire * 2)
+    assert (simulation.calculate('salaire') == salaire).all()
+    assert simulation.calculate('revenu_disponible') is array
+    assert (fork.calculate('revenu_disponible') != array).any()
+    # Arrays are copied when a simulation modifies them.
+    writable_array = simulation.get_holder('revenu_disponible').get_writable_array()
+    assert writable_array is not array and (writable_array == array).all()
+    writable_array[0] = -1
+    assert array[0] != -1
+
+
+def test_save_load():
+    directory = tempfile.mkdtemp(prefix = 'openfisca-')
+    try:
+        simulation = dummy_country.new_simulation(tax_benefit_system, 10, random_seed = 3)
+        array = simulation.calculate('revenu_disponible')
+        simulation.save(directory)
+        loaded_simulation = simulations.Simulation.load(directory, tax_benefit_system = tax_benefit_system)
+        assert loaded_simulation.date == simulation.date
+        assert loaded_simulation.random_seed == 3
+        assert loaded_simulation.get_holder('revenu_disponible').kind == u'computed'
+        assert (loaded_simulation.calculate('revenu_disponible') == array).all()
+        assert (loaded_simulation.calculate('alea_menage') == simulation.calculate('alea_menage')).all()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_save_load_reform():
+    directory = tempfile.mkdtemp(prefix = 'openfisca-')
+    try:
+        simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+        reform = simulation.fork(compact_legislation = legislations.patch_compact_node(simulation.compact_legislation,
+            ('ir', 'bonus'), 100))
+        reform.save(directory, inputs_only = True)
+        loaded_reform = simulations.Simulation.load(directory, tax_benefit_system = tax_benefit_system)
+        assert loaded_reform.get_holder('revenu_disponible', None) is None
+        assert (loaded_reform.calculate('revenu_disponible') == reform.calculate('revenu_disponible')).all()
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_set_input_invalidates_consumers():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    array = simulation.calculate('revenu_disponible')
+    impot_menage = simulation.calculate('impot_menage')
+    simulation.set_input('age', simulation.calculate('age') + 1)
+    assert simulation.calculate('revenu_disponible') is array
+    salaire = simulation.calculate('salaire')
+    simulation.set_input('salaire', salaire * 2)
+    assert simulation.get_holder('impot_menage').array is None
+    assert np.allclose(simulation.calculate('impot_menage'), impot_menage * 2)
+
+
+def test_memory_report():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    simulation.calculate('revenu_disponible')
+    report = simulation.memory_report()
+    assert report['bytes'] == sum(report['bytes_by_holder'].itervalues()) == sum(report['bytes_by_kind'].itervalues())
+    assert report['bytes_by_holder']['revenu_disponible'] == 10 * 4
+    assert report['bytes_by_kind'][u'computed'] > 0
+    simulation.invalidate(['revenu_disponible'])
+    assert simulation.memory_report()['bytes'] == report['bytes'] - 10 * 4
+    assert simulation.memory_report()['peak_bytes'] >= report['bytes']
+
+
+def test_sweep():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 2)
+    array_by_column_name = simulation.sweep([
+        dict(count = 3, max = 20000, min = 0, name = 'salaire'),
+        dict(count = 2, index = 1, max = 1000, min = 0, name = 'salaire'),
+        ], ['impot', 'revenu_disponible'])
+    assert array_by_column_name['impot'].shape == (3, 2, simulation.persons.count)
+    assert array_by_column_name['revenu_disponible'].shape == (3, 2, 2)
+    salaire = simulation.calculate('salaire')
+    for index, value in enumerate((0, 10000, 20000)):
+        for other_index, other_value in enumerate((0, 1000)):
+            point = simulation.fork()
+            point_salaire = salaire.copy()
+            point_salaire[0] = value
+            point_salaire[1] = other_value
+            point.set_input('salaire', point_salaire)
+            assert np.allclose(array_by_column_name['impot'][index, other_index], point.calculate('impot'))
+            assert np.allclose(array_by_column_name['revenu_disponible'][index, other_index],
+                point.calculate('revenu_disponible'))
+
+
+def test_marginal_rates():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    rates_by_column_name = simulation.calculate_marginal_rates('salaire', [100, 1000], ['impot', 'salaire_net'])
+    assert rates_by_column_name['impot'].shape == (2, simulation.persons.count)
+    assert np.allclose(rates_by_column_name['impot'], 0.2, atol = 1e-3)
+    assert np.allclose(rates_by_column_name['salaire_net'], 0.8, atol = 1e-3)
+    assert simulation.get_holder('impot').array is not None
+
+
+def test_solve_input():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10)
+    targets = np.linspace(1000, 20000, simulation.persons.count)
+    for entity in (None, 'menage'):
+        solution = simulation.solve_input('salaire', 'salaire_net', targets, 0, 100000, entity = entity)
+        assert np.allclose(solution, targets / 0.8, atol = 0.1), entity
+    # Rows that are not bracketed are not solved.
+    assert np.isnan(simulation.solve_input('salaire', 'salaire_net', targets, 0, 10)).all()
+
+
+def test_extract():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 10, random_seed = 3, shuffle_persons = True)
+    array = simulation.calculate('revenu_disponible')
+    alea_menage = simulation.calculate('alea_menage')
+    households_index = np.array([2, 5])
+    household = simulation.extract(households_index, entity = 'menage')
+    assert household.entity_by_key_singular['menage'].count == 2
+    assert household.get_holder('revenu_disponible').kind == u'computed'
+    assert (household.calculate('revenu_disponible') == array[households_index]).all()
+    household.invalidate(['alea_menage'])
+    assert (household.calculate('alea_menage') == alea_menage[households_index]).all()
+    persons_index = np.nonzero(np.in1d(simulation.calculate('idmen'), households_index))[0]
+    assert (household.calculate('salaire') == simulation.calculate('salaire')[persons_index]).all()
+
+
+if __name__ == '__main__':
+    test_fork_shares_arrays()
+    test_save_load()
+    test_save_load_reform()
+    test_set_input_invalidates_consumers()
+    test_memory_report()
+    test_sweep()
+    test_marginal_rates()
+    test_solve_input()
+    test_extract()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check that sums by entity on persons sorted by household (see Simulation.sort_persons) are bit-identical."""
+
+
+import numpy as np
+
+from .. import shards
+from . import dummy_country
+
+
+tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+
+
+def check_equals_unsorted(column_name):
+    simulation = dummy_country.new_simulation(tax_benefit_system, 1000, shuffle_persons = True)
+    array = simulation.fork().calculate(column_name)
+    assert simulation.entity_by_key_singular['menage'].get_members_offsets() is None
+    simulation.sort_persons('menage')
+    assert simulation.entity_by_key_singular['menage'].get_members_offsets() is not None
+    sorted_array = simulation.restore_order(simulation.calculate(column_name), entity = 'menage')
+    assert sorted_array.dtype == np.float32
+    assert sorted_array.tostring() == array.tostring(), column_name
+
+
+def test_chunks_equal_serial():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 200, shuffle_persons = True)
+    array = simulation.fork().calculate('revenu_menage')
+    chunks_array = np.concatenate([
+        array_by_column_name['revenu_menage']
+        for index_by_key_plural, array_by_column_name in simulation.calculate_by_chunks(['revenu_menage'],
+            chunk_size = 1, entity = 'menage')
+        ])
+    assert chunks_array.tostring() == array.tostring()
+
+
+def test_shards_equal_serial():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 200, shuffle_persons = True)
+    array_by_column_name = shards.calculate_with_processes(simulation, ['revenu_menage'], entity = 'menage',
+        processes_count = 2, shards_count = 200)
+    assert array_by_column_name['revenu_menage'].tostring() == simulation.calculate('revenu_menage').tostring()
+
+
+def test_sorted_sums_equal_unsorted():
+    for column_name in ('impot_menage', 'revenu_menage', 'revenu_disponible'):
+        yield check_equals_unsorted, column_name
+
+
+def test_sort_persons_keeps_streams():
+    simulation = dummy_country.new_simulation(tax_benefit_system, 100, shuffle_persons = True, random_seed = 3)
+    array = simulation.fork().calculate('alea')
+    simulation.sort_persons('menage')
+    assert (simulation.restore_order(simulation.calculate('alea')) == array).all()
+
+
+if __name__ == '__main__':
+    test_chunks_equal_serial()
+    test_shards_equal_serial()
+    for function, column_name in test_sorted_sums_equal_unsorted():
+        function(column_name)
+    test_sort_persons_keeps_streams()
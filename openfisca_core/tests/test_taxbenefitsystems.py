@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+
+# OpenFisca -- A versatile microsimulation software
+# By: OpenFisca Team <contact@openfisca.fr>
+#
+# Copyright (C) 2011, 2012, 2013, 2014 OpenFisca Team
+# https://github.com/openfisca
+#
+# This file is part of OpenFisca.
+#
+# OpenFisca is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# OpenFisca is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Check the caches and snapshots of tax-benefit systems."""
+
+
+import datetime
+import gc
+import os
+import shutil
+import tempfile
+import weakref
+
+import numpy as np
+
+from . import dummy_country
+
+
+def new_tax_benefit_system_class(legislation_xml_file_path):
+    return type('CopiedTaxBenefitSystem', (dummy_country.DummyTaxBenefitSystem,), dict(
+        PARAM_FILE = legislation_xml_file_path,
+        ))
+
+
+def test_simulation_template_kept_between_simulations():
+    tax_benefit_system = dummy_country.DummyTaxBenefitSystem()
+    template_reference = weakref.ref(dummy_country.new_simulation(tax_benefit_system, 1).template)
+    gc.collect()
+    assert template_reference() is not None
+    assert dummy_country.new_simulation(tax_benefit_system, 1).template is template_reference()
+    for year in range(2000, 2010):
+        tax_benefit_system.get_simulation_template(datetime.date(year, 1, 1))
+    gc.collect()
+    assert len(tax_benefit_system.simulation_template_by_date_str) \
+        == tax_benefit_system.recent_simulation_templates_count
+    tax_benefit_system.update_legislation()
+    assert tax_benefit_system.simulation_template_by_date_str is None
+
+
+def test_snapshot():
+    directory = tempfile.mkdtemp(prefix = 'openfisca-')
+    try:
+        legislation_xml_file_path = os.path.join(directory, 'legislation.xml')
+        shutil.copy(dummy_country.DummyTaxBenefitSystem.PARAM_FILE, legislation_xml_file_path)
+        tax_benefit_system_class = new_tax_benefit_system_class(legislation_xml_file_path)
+        tax_benefit_system = tax_benefit_system_class()
+        snapshot_path = os.path.join(directory, 'snapshot.pickle')
+        tax_benefit_system.save_snapshot(snapshot_path)
+        loaded_tax_benefit_system = tax_benefit_system_class.load_snapshot(snapshot_path)
+        assert loaded_tax_benefit_system.legislation_json == tax_benefit_system.legislation_json
+        assert loaded_tax_benefit_system.get_date_dependent_column_names() \
+            == tax_benefit_system.get_date_dependent_column_names()
+        assert np.allclose(dummy_country.new_simulation(loaded_tax_benefit_system, 10).calculate('revenu_disponible'),
+            dummy_country.new_simulation(tax_benefit_system, 10).calculate('revenu_disponible'))
+
+        # A snapshot older than its legislation is refused.
+        mtime = os.path.getmtime(legislation_xml_file_path)
+        os.utime(legislation_xml_file_path, (mtime + 10, mtime + 10))
+        try:
+            tax_benefit_system_class.load_snapshot(snapshot_path)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Stale snapshot must be refused'
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    test_simulation_template_kept_between_simulations()
+    test_snapshot()